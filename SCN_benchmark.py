@@ -0,0 +1,151 @@
+'''
+Semantic Compositional Network https://arxiv.org/pdf/1611.08002.pdf
+Decoding benchmark on random weights of the real SCN shapes, no COCO data needed
+'''
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+from collections import OrderedDict
+
+from model_scn.img_cap import init_params
+from model_scn.utils import uniform_weight
+from SCN_decode import compute_dtype, prepare_params, stack_params, predict
+
+
+def synthetic_params(n_models, n_words=8791, n_x=300, n_h=512, n_f=512, n_z=2048, n_y=999, dtype='float32', seed=1234):
+
+    """ Random weights of an ensemble of n_models, initialized like
+        SCN_training.py does (see init_params), in dtype
+    """
+    options = {'n_words': n_words, 'n_x': n_x, 'n_h': n_h, 'n_f': n_f, 'n_z': n_z, 'n_y': n_y}
+    params_set = []
+    for ii in xrange(n_models):
+        np.random.seed(seed + ii)
+        params = init_params(options, uniform_weight(n_words, n_x))
+        params_set.append(OrderedDict((kk, pp.astype(dtype)) for kk, pp in params.iteritems()))
+
+    return params_set
+
+def synthetic_features(n_images, n_z=2048, n_y=999, dtype='float32', seed=1234):
+
+    """ Non-negative image features like the ResNet ones and tag
+        probabilities with a few likely tags per image, size of (n_images, n_z)
+        and (n_images, n_y)
+    """
+    rng = np.random.RandomState(seed)
+    z = np.maximum(rng.randn(n_images, n_z), 0.)
+    y = rng.rand(n_images, n_y) ** 8
+
+    return z.astype(dtype), y.astype(dtype)
+
+def benchmark(n_images, batch_size, beam_size, n_models, precision, max_step=20, repeats=1, seed=1234):
+
+    """ Decode n_images in requests of batch_size images, repeats times.
+        Returns the throughput and the percentiles of the request latency.
+    """
+    params = stack_params(prepare_params(synthetic_params(n_models, dtype=precision, seed=seed)))
+    z, y = synthetic_features(n_images, dtype=compute_dtype(precision), seed=seed)
+
+    latencies = []
+    n_tokens = 0
+    started = time.time()
+    for _ in xrange(repeats):
+        for start in xrange(0, n_images, batch_size):
+            t = time.time()
+            for i, pred in predict(z[start:start + batch_size], y[start:start + batch_size], params, beam_size,
+                                   max_step, batch_size):
+                n_tokens += len(pred[0][1])
+            latencies.append(time.time() - t)
+    seconds = time.time() - started
+
+    return OrderedDict([
+        ('images_per_sec', repeats * n_images / seconds),
+        ('tokens_per_sec', n_tokens / seconds),
+        ('latency_p50', np.percentile(latencies, 50)),
+        ('latency_p90', np.percentile(latencies, 90)),
+        ('latency_p99', np.percentile(latencies, 99)),
+    ])
+
+def compare(results, baseline, tolerance):
+
+    """ Returns a message for every setting of baseline that results got
+        slower on by more than tolerance (a fraction), in throughput or in
+        p90 latency
+    """
+    regressions = []
+    for name, base in baseline.iteritems():
+        if name not in results:
+            continue
+        res = results[name]
+        if res['images_per_sec'] < base['images_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.2f images/sec, baseline %.2f' % (name, res['images_per_sec'], base['images_per_sec']))
+        if res['latency_p90'] > base['latency_p90'] * (1 + tolerance):
+            regressions.append('%s: p90 latency %.3fs, baseline %.3fs' % (name, res['latency_p90'], base['latency_p90']))
+
+    return regressions
+
+def _int_list(s):
+    return [int(v) for v in s.split(',')]
+
+def check_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--images", help="Number of images of every setting, comma separated", type=_int_list, default=[200]
+    )
+    parser.add_argument(
+        "--batch-size", help="Number of images of one request", type=int, default=50
+    )
+    parser.add_argument(
+        "--beam-sizes", help="Beam sizes, comma separated", type=_int_list, default=[1, 5]
+    )
+    parser.add_argument(
+        "--ensembles", help="Ensemble sizes, comma separated", type=_int_list, default=[1, 6]
+    )
+    parser.add_argument(
+        "--precisions", help="Weight precisions, comma separated", type=lambda s: s.split(','), default=['float32']
+    )
+    parser.add_argument(
+        "--repeats", help="Number of times every setting is decoded", type=int, default=1
+    )
+    parser.add_argument(
+        "--output", help="Write the results to this JSON file", default=None
+    )
+    parser.add_argument(
+        "--baseline", help="Fail if a setting got slower than in this JSON file of earlier results", default=None
+    )
+    parser.add_argument(
+        "--tolerance", help="Slowdown against --baseline that still passes, as a fraction", type=float, default=0.1
+    )
+
+    parsed_args = parser.parse_args(args)
+    print(parsed_args)
+    return parsed_args
+
+if __name__ == '__main__':
+    parsed_args = check_args(sys.argv[1:])
+
+    results = OrderedDict()
+    for n_images, beam_size, n_models, precision in itertools.product(
+            parsed_args.images, parsed_args.beam_sizes, parsed_args.ensembles, parsed_args.precisions):
+        name = 'images_%d_batch_%d_beam_%d_models_%d_%s' % (n_images, parsed_args.batch_size, beam_size, n_models,
+                                                            precision)
+        results[name] = benchmark(n_images, parsed_args.batch_size, beam_size, n_models, precision,
+                                  repeats=parsed_args.repeats)
+        print '%s: %.2f images/sec, %.1f tokens/sec, latency p50 %.3fs p90 %.3fs p99 %.3fs' % ((name,) + tuple(
+            results[name].values()))
+
+    if parsed_args.output:
+        print 'write results to %s' % parsed_args.output
+        json.dump(results, open(parsed_args.output, 'w'), indent=1)
+
+    if parsed_args.baseline:
+        regressions = compare(results, json.load(open(parsed_args.baseline)), parsed_args.tolerance)
+        for msg in regressions:
+            print 'REGRESSION %s' % msg
+        if regressions:
+            sys.exit(1)
+        print 'no regression against %s' % parsed_args.baseline
@@ -4,208 +4,989 @@ Developed by Zhe Gan, zg27@duke.edu, July, 12, 2016
 Optimized by Xiaodong He, xiaohe@microsoft.com, Jan. 2017
 '''
 import argparse
+import ctypes
 import datetime
 import cPickle
+import hashlib
+import multiprocessing
 import os
+import resource
+import shutil
 import sys
+import tempfile
+import time
 
-import scipy.io
 import numpy as np
 import json
+import theano
+import theano.tensor as tensor
 from collections import OrderedDict, defaultdict
 
-from SCN_training import get_splits_from_occurrences_data
+from SCN_training import load_split_index, assign_splits, load_corpus
+from SCN_features import load_features, gather_features
+from model_scn.img_cap import build_step
+from model_scn.lstm_layers import fuse_gate_params
 
 
-def load_params(path):
+def load_params(path, dtype=None):
 
+    """ dtype: float64 (the default) or float32, or float16 to halve the storage
+        of the loaded weights (the decoder then computes in float32)
+        path may also be a directory written by save_model, it is memory-mapped
+        and keeps the precision it was exported with, a different dtype is an error
+    """
     print 'loading learned params from %s' % path
+    if os.path.isdir(path):
+        params = load_model(path)
+        if dtype is not None and storage_dtype(params) != dtype:
+            raise ValueError('%s was exported in %s, not %s' % (path, storage_dtype(params), dtype))
+        return params
     
+    dtype = dtype or 'float64'
     params = OrderedDict()
     data = np.load(path)
     for kk, pp in data.iteritems():
-        params[kk] = data[kk].astype('float64')
+        params[kk] = data[kk].astype(dtype)
+    fuse_gate_params(params)
+
+    return params
+
+def save_model(params, path):
+
+    """ Write every array of params to path as a raw .npy file, listed in
+        path/manifest.json, so that load_model can map them without copying.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    manifest = []
+    for kk, pp in params.iteritems():
+        pp = np.ascontiguousarray(pp)
+        np.save(os.path.join(path, kk + '.npy'), pp)
+        manifest.append({'name': kk, 'dtype': pp.dtype.str, 'shape': pp.shape})
+    json.dump({'arrays': manifest}, open(os.path.join(path, 'manifest.json'), 'w'), indent=1)
+
+def load_model(path):
+
+    """ Open the arrays written by save_model read-only and memory-mapped,
+        processes on one host then share them through the page cache.
+    """
+    params = OrderedDict()
+    manifest = json.load(open(os.path.join(path, 'manifest.json')))
+    for entry in manifest['arrays']:
+        pp = np.load(os.path.join(path, entry['name'] + '.npy'), mmap_mode='r')
+        if pp.dtype.str != entry['dtype'] or list(pp.shape) != entry['shape']:
+            raise ValueError('%s in %s does not match its manifest' % (entry['name'], path))
+        params[str(entry['name'])] = pp
 
     return params
 
+def export_model(params, path, quantize_output=False):
+
+    """ Save params together with their decoding tables (see prepare_params),
+        decoding from the export then skips all preparation.
+    """
+    prepare_params([params], quantize_output)
+    save_model(params, path)
+
 def _p(pp, name):
     return '%s_%s' % (pp, name)
 
-def predict(z, params_set, beam_size, max_step, prefix='encoder_lstm'):
+def storage_dtype(params):
+    # the precision the weights were loaded in, prepare_params upcasts the decoding
+    # weights of float16 models but keeps Wemb as it is
+    return params['Wemb'].dtype
+
+def compute_dtype(dtype):
+    # float16 is only a storage format, numpy has no fast float16 matrix products
+    return np.promote_types(dtype, 'float32')
+
+def quantize_columns(W):
 
-    """ z: size of (n_z, 1)
+    """ Symmetric int8 quantization of W with one scale per column.
+        Returns the quantized W.T, size of (n_cols, n_rows), so that a block
+        of columns is a contiguous block of rows, and the scales.
     """
-    def _slice(_x, n, dim):
-        return _x[n*dim:(n+1)*dim]
+    scale = np.amax(np.abs(W), axis=0) / 127.
+    scale[scale == 0] = 1.
+    q = np.round(W / scale).astype('int8')
 
-    def sigmoid(x):
-        return 1/(1+np.exp(-x))
+    return np.ascontiguousarray(q.T), scale.astype(W.dtype)
 
-    n_h = params_set[0][_p(prefix,'Ua_i')].shape[0]
+def quantized_dot(h, qT, scale, block=1024):
 
-    def _step_set(x_prev, h_prev, c_prev, x_prev_id, h_prev_id, params):
-        if x_prev_id >= 0 and params[_p(prefix, 'cacheX')].has_key(x_prev_id):
-            tmp1_i = params[_p(prefix, 'cacheX')][x_prev_id][0]
-            tmp1_f = params[_p(prefix, 'cacheX')][x_prev_id][1]
-            tmp1_o = params[_p(prefix, 'cacheX')][x_prev_id][2]
-            tmp1_c = params[_p(prefix, 'cacheX')][x_prev_id][3]
-        else:
-            tmp1_i = np.dot((np.dot(x_prev, params[_p(prefix, 'Wa_i')]) * params[_p(prefix, 'yWb_i')]), params[_p(prefix, 'Wc_i')].T)
-            tmp1_f = np.dot((np.dot(x_prev, params[_p(prefix, 'Wa_f')]) * params[_p(prefix, 'yWb_f')]), params[_p(prefix, 'Wc_f')].T)
-            tmp1_o = np.dot((np.dot(x_prev, params[_p(prefix, 'Wa_o')]) * params[_p(prefix, 'yWb_o')]), params[_p(prefix, 'Wc_o')].T)
-            tmp1_c = np.dot((np.dot(x_prev, params[_p(prefix, 'Wa_c')]) * params[_p(prefix, 'yWb_c')]), params[_p(prefix, 'Wc_c')].T)
-            if x_prev_id >= 0: #not for -1 which is sent start
-                params[_p(prefix, 'cacheX')][x_prev_id] = ((tmp1_i, tmp1_f, tmp1_o, tmp1_c))
-
-        if h_prev_id >= 0 and params[_p(prefix, 'cacheH')].has_key(h_prev_id):
-            tmp2_i = params[_p(prefix, 'cacheH')][h_prev_id][0]
-            tmp2_f = params[_p(prefix, 'cacheH')][h_prev_id][1]
-            tmp2_o = params[_p(prefix, 'cacheH')][h_prev_id][2]
-            tmp2_c = params[_p(prefix, 'cacheH')][h_prev_id][3]
-        else:
-            tmp2_i = np.dot((np.dot(h_prev, params[_p(prefix, 'Ua_i')]) * params[_p(prefix, 'yUb_i')]), params[_p(prefix, 'Uc_i')].T)
-            tmp2_f = np.dot((np.dot(h_prev, params[_p(prefix, 'Ua_f')]) * params[_p(prefix, 'yUb_f')]), params[_p(prefix, 'Uc_f')].T)
-            tmp2_o = np.dot((np.dot(h_prev, params[_p(prefix, 'Ua_o')]) * params[_p(prefix, 'yUb_o')]), params[_p(prefix, 'Uc_o')].T)
-            tmp2_c = np.dot((np.dot(h_prev, params[_p(prefix, 'Ua_c')]) * params[_p(prefix, 'yUb_c')]), params[_p(prefix, 'Uc_c')].T)
-            if h_prev_id >= 0: #not for -1 which is sent start
-                params[_p(prefix, 'cacheH')][h_prev_id] = ((tmp2_i, tmp2_f, tmp2_o, tmp2_c))
-
-        preact_i = tmp1_i + tmp2_i + params[_p(prefix, 'b_i')]
-        preact_f = tmp1_f + tmp2_f + params[_p(prefix, 'b_f')]
-        preact_o = tmp1_o + tmp2_o + params[_p(prefix, 'b_o')]
-        preact_c = tmp1_c + tmp2_c + params[_p(prefix, 'b_c')]
-
-        i = sigmoid(preact_i)
-        f = sigmoid(preact_f)
-        o = sigmoid(preact_o)
-        c = np.tanh(preact_c)
-
-        c = f * c_prev + i * c
-        h = o * np.tanh(c)
-
-        Vhid = params['vWemb']
-        y0 = np.dot(h, Vhid) + params['bhid']
-
-        return y0, h, c
-    
-    # calculate the prob. of next word using ensemble
-    p0 = 0.
-    num = len(params_set)
-    h0_set = []
-    c0_set = []
+    """ h: size of (n, n_rows), qT and scale as returned by quantize_columns,
+        or all three stacked along a leading model axis
+        The int8 weights are dequantized one block of columns at a time into a
+        small float buffer that stays in cache, and the scales are applied to
+        the product instead of the weights.
+    """
+    n_cols = qT.shape[-2]
+    out = np.empty(h.shape[:-1] + (n_cols,), dtype=h.dtype)
+    buf = np.empty(qT.shape[:-2] + (min(block, n_cols), qT.shape[-1]), dtype=h.dtype)
+    for start in xrange(0, n_cols, block):
+        end = min(start + block, n_cols)
+        np.copyto(buf[..., :end - start, :], qT[..., start:end, :], casting='unsafe')
+        out[..., start:end] = np.matmul(h, np.swapaxes(buf[..., :end - start, :], -1, -2))
+    out *= np.expand_dims(scale, -2)
+
+    return out
+
+def prepare_params(params_set, quantize_output=False, prefix='encoder_lstm'):
+
+    """ Add the decoding tables to every params, in the compute dtype.
+        quantize_output: replace vWemb by an int8 copy with one scale per word
+        Params exported by export_model already have their tables.
+    """
     for params in params_set:
-        z0 =np.dot(z,params['C0'])
-        h0 = np.zeros((n_h,))
-        c0 = np.zeros((n_h,))
-        (y0, h0, c0) = _step_set(z0, h0, c0, -1, -1, params) 
-        h0_set.append(h0)
-        c0_set.append(c0)
-        maxy0 = np.amax(y0)
-        e0 = np.exp(y0 - maxy0) # for numerical stability shift into good numerical range
-        p0 = p0 + e0 / np.sum(e0)
-    
-    p0 = p0 / num
-    y0 = np.log(1e-20 + p0) # and back to log domain
-
-    beams = []
-    nsteps = 1
-    # generate the first word
-    top_indices = np.argsort(-y0)  # we do -y because we want decreasing order
-
-    # perform BEAM search.
-    for i in xrange(beam_size):
-        wordix = top_indices[i]
-        # log probability, indices of words predicted in this beam so far, and the hidden and cell states
-        beams.append((y0[wordix], [wordix], h0_set, c0_set, 0)) #add state id, too, e.g., 0 here
-    # generate the rest n words
+        if 'vWemb' in params or 'vWemb_q' in params:
+            if quantize_output and 'vWemb' in params:
+                params['vWemb_q'], params['vWemb_scale'] = quantize_columns(params.pop('vWemb'))
+            continue
+        dtype = compute_dtype(params['Wemb'].dtype)
+        params['vWemb'] = np.dot(params['Vhid'].astype(dtype), params['Wemb'].T.astype(dtype))
+        # projections of every word onto Wa, size of (n_words, 4 * n_f)
+        params[_p(prefix, 'WembWa')] = np.dot(params['Wemb'].astype(dtype), params[_p(prefix, 'Wa')].astype(dtype))
+        # Wc/Uc as (4, n_f, n_h) stacks, so the four gates are one batched GEMM
+        n_h = params[_p(prefix, 'Wc')].shape[0]
+        params[_p(prefix, 'WcT')] = np.ascontiguousarray(params[_p(prefix, 'Wc')].reshape((n_h, 4, -1)).transpose(1, 2, 0), dtype=dtype)
+        params[_p(prefix, 'UcT')] = np.ascontiguousarray(params[_p(prefix, 'Uc')].reshape((n_h, 4, -1)).transpose(1, 2, 0), dtype=dtype)
+        # the weights used directly by the decoding steps
+        for kk in ['C0', 'bhid', _p(prefix, 'Wa'), _p(prefix, 'Wb'), _p(prefix, 'Ua'), _p(prefix, 'Ub'), _p(prefix, 'b')]:
+            params[kk] = params[kk].astype(dtype, copy=False)
+        if quantize_output:
+            vWemb = params.pop('vWemb')
+            params['vWemb_q'], params['vWemb_scale'] = quantize_columns(vWemb)
+            print 'int8 output projection: %.1f MB instead of %.1f MB' % (
+                (params['vWemb_q'].nbytes + params['vWemb_scale'].nbytes) / 2.**20, vWemb.nbytes / 2.**20)
+
+    return params_set
+
+def stack_params(params_set, prefix='encoder_lstm'):
+
+    """ Stack the decoding tables of the ensemble into (n_models, ...) arrays,
+        so that predict evaluates all members with one batched product.
+    """
+    keys = ['C0', 'bhid', _p(prefix, 'Wa'), _p(prefix, 'Wb'), _p(prefix, 'Ua'), _p(prefix, 'Ub'), _p(prefix, 'b'),
+            _p(prefix, 'WembWa'), _p(prefix, 'WcT'), _p(prefix, 'UcT')]
+    keys += ['vWemb_q', 'vWemb_scale'] if 'vWemb_q' in params_set[0] else ['vWemb']
+    stacked = OrderedDict()
+    for kk in keys:
+        if len(params_set) == 1:
+            stacked[kk] = params_set[0][kk][None] # a view, an exported model stays memory-mapped
+        else:
+            stacked[kk] = np.stack([params[kk] for params in params_set])
+
+    return stacked
+
+def compile_step(params_set, prefix='encoder_lstm'):
+
+    """ Compile one decoding step of the ensemble from the graph of the model
+        (see build_step), params_set as returned by prepare_params.
+        f(h, c, x, first, z, y, mask) -> (log probs of the next words, h, c)
+        h, c: size of (n_models, n_live, n_h), x: the previous word of every
+        row, first: 1 for the rows fed the image features z, y: the tags,
+        mask: 1 for the words each row may use, size of (n_live, n_words)
+    """
+    dtype = compute_dtype(params_set[0]['bhid'].dtype)
+    h = tensor.tensor3('h', dtype=dtype)
+    c = tensor.tensor3('c', dtype=dtype)
+    x = tensor.lvector('x')
+    first = tensor.bvector('first')
+    z = tensor.matrix('z', dtype=dtype)
+    y = tensor.matrix('y', dtype=dtype)
+    mask = tensor.bmatrix('mask')
+
+    used = ['Wemb', 'C0', 'vWemb', 'bhid'] + [_p(prefix, kk) for kk in ['Wa', 'Wb', 'Wc', 'Ua', 'Ub', 'Uc', 'b']]
+    minus_inf = np.asarray(-np.inf, dtype=dtype)
+    p, h_set, c_set = 0, [], []
+    for ii, params in enumerate(params_set):
+        if 'vWemb' not in params:
+            raise ValueError('the compiled step needs the float output projection, not the int8 one')
+        tparams = OrderedDict((kk, theano.shared(np.asarray(params[kk], dtype=dtype), name=kk)) for kk in used)
+        pred_x, h1, c1 = build_step(tparams, h[ii], c[ii], x, first, z, y, prefix)
+        # average the softmax probs of the ensemble over the words allowed by mask
+        p += tensor.nnet.softmax(tensor.switch(mask, pred_x, minus_inf))
+        h_set.append(h1)
+        c_set.append(c1)
+    logp = tensor.switch(mask, tensor.log(np.asarray(1e-20, dtype=dtype) + p / len(params_set)), minus_inf)
+
+    return theano.function([h, c, x, first, z, y, mask], [logp, tensor.stack(h_set), tensor.stack(c_set)])
+
+def load_shortlist(path, n_tags=10, min_tag_prob=0.2):
+
+    """ Load a tag-driven vocabulary shortlist built by SCN_shortlist.py.
+        n_tags: number of top tags of an image whose words are candidates
+        min_tag_prob: images without any tag this likely use the full vocabulary
+    """
+    data = np.load(path)
+    shortlist = {'frequent_words': data['frequent_words'], 'tag_words': data['tag_words'],
+                 'n_tags': n_tags, 'min_tag_prob': min_tag_prob,
+                 'n_images': 0, 'n_fallback': 0, 'n_candidates': 0}
+
+    return shortlist
+
+def image_shortlists(y, shortlist, n_words):
+
+    """ y: tag probabilities, size of (n_images, n_y)
+        Returns the candidate words of each image as a boolean mask of size
+        (n_images, n_words): the frequent words, the end token and the words
+        associated with the image's top tags, or the full vocabulary for an
+        image without a confident tag.
+    """
+    mask = np.zeros((y.shape[0], n_words), dtype=bool)
+    mask[:, shortlist['frequent_words']] = True
+    mask[:, 0] = True
+    top_tags = np.argsort(-y, axis=1)[:, :shortlist['n_tags']]
+    mask[np.arange(y.shape[0])[:, None, None], shortlist['tag_words'][top_tags]] = True
+    mask[np.amax(y, axis=1) < shortlist['min_tag_prob']] = True
+
+    return mask
+
+def sigmoid(x):
+    return 1/(1+np.exp(-x))
+
+def _slice(_x, n, dim):
+    return _x[..., n*dim:(n+1)*dim]
+
+def _gate_dot(x, WT):
+
+    """ x: size of (n_models, n_live, 4 * n_f), WT: the (n_models, 4, n_f, n_h)
+        stacked transposes of Wc/Uc
+        Returns the (n_models, n_live, 4 * n_h) preactivations of the i/f/o/c
+        gates, one batched GEMM for the four gates of all members
+    """
+    n_models, _, n_f, n_h = WT.shape
+    n = x.shape[1]
+    x = x.reshape((n_models, n, 4, n_f)).transpose(0, 2, 1, 3)
+
+    return np.matmul(x, WT).transpose(0, 2, 1, 3).reshape((n_models, n, 4 * n_h))
+
+def _tick(profile, stage, t):
+
+    """ Add the time since t to stage of profile and return the current time,
+        nothing is timed without a profile
+    """
+    if profile is None:
+        return t
+    now = time.time()
+    profile[stage] = profile.get(stage, 0.) + now - t
+    return now
+
+def _count(profile, name, n):
+    if profile is not None:
+        profile[name] = profile.get(name, 0) + n
+
+def _step_set(params, tmp1, h_prev, c_prev, yUb, cols, prefix='encoder_lstm', profile=None):
+
+    """ One LSTM step of the stacked ensemble, see predict.
+        tmp1: input projections of the i/f/o/c gates, size of (n_models, n_live, 4 * n_h)
+        h_prev, c_prev: size of (n_models, n_live, n_h)
+        yUb: the tag modulations of each row, size of (n_models, n_live, 4 * n_f)
+        cols: the words to score, None for the full vocabulary
+        profile: dict the time of each stage is added to, see generate
+    """
+    t = time.time()
+    n_h = h_prev.shape[2]
+    tmp2 = _gate_dot(np.matmul(h_prev, params[_p(prefix, 'Ua')]) * yUb, params[_p(prefix, 'UcT')])
+    t = _tick(profile, 'recurrent_projection', t)
+
+    preact = tmp1 + tmp2 + params[_p(prefix, 'b')][:, None]
+
+    i = sigmoid(_slice(preact, 0, n_h))
+    f = sigmoid(_slice(preact, 1, n_h))
+    o = sigmoid(_slice(preact, 2, n_h))
+    c = np.tanh(_slice(preact, 3, n_h))
+
+    c = f * c_prev + i * c
+    h = o * np.tanh(c)
+    t = _tick(profile, 'gates', t)
+
+    if 'vWemb_q' in params:
+        qT, scale = params['vWemb_q'], params['vWemb_scale']
+        if cols is not None:
+            qT, scale = qT[:, cols], scale[:, cols]
+        y0 = quantized_dot(h, qT, scale)
+    else:
+        Vhid = params['vWemb'] if cols is None else params['vWemb'][:, :, cols]
+        y0 = np.matmul(h, Vhid)
+    y0 += (params['bhid'] if cols is None else params['bhid'][:, cols])[:, None]
+    _tick(profile, 'output_projection', t)
+
+    return y0, h, c
+
+def _log_prob(y, mask):
+    # average the softmax probs of the ensemble, row by row, over the words allowed by mask
+    if mask is not None:
+        y = np.where(mask, y, -np.inf)
+    e = np.exp(y - np.amax(y, axis=2)[..., None]) # for numerical stability shift into good numerical range
+    p = np.mean(e / np.sum(e, axis=2)[..., None], axis=0)
+    logp = np.log(1e-20 + p) # and back to log domain
+    if mask is not None:
+        logp[~mask] = -np.inf
+    return logp
+
+def _shortlist_cols(allowed):
+
+    """ allowed: the candidate words of each row, size of (n_live, n_words)
+        Returns the words to score (None for all of them) and the mask of the
+        scored words each row may use (None if every row may use all of them)
+    """
+    cols = np.flatnonzero(np.any(allowed, axis=0))
+    if len(cols) == allowed.shape[1]:
+        cols = None
+    mask = allowed if cols is None else allowed[:, cols]
+    if np.all(mask):
+        mask = None
+
+    return cols, mask
+
+def predict_greedy(z_emb, y_emb, params, max_step, chunk=512, shortlist=None, prefix='encoder_lstm', profile=None):
+
+    """ The beam_size 1 case of predict without the beam bookkeeping: chunk
+        images are advanced together as (n_models, chunk, n_h) states, every row
+        takes the argmax of its ensemble probs and the rows that emitted the end
+        token are dropped from the next steps.
+        Yields (image index, [(log prob, word ids)]) in image order.
+    """
+    n_images = z_emb.shape[0]
+    n_words = params['bhid'].shape[1]
+    dtype = params['bhid'].dtype
+
+    for start in xrange(0, n_images, chunk):
+        clock = time.time()
+        idx = range(start, min(start + chunk, n_images))
+        n = len(idx)
+        yWb = np.matmul(y_emb[idx], params[_p(prefix, 'Wb')])
+        yUb = np.matmul(y_emb[idx], params[_p(prefix, 'Ub')])
+        if shortlist is not None:
+            allowed = image_shortlists(y_emb[idx], shortlist, n_words)
+            n_candidates = np.sum(allowed, axis=1)
+            shortlist['n_images'] += n
+            shortlist['n_fallback'] += np.sum(n_candidates == n_words)
+            shortlist['n_candidates'] += np.sum(n_candidates)
+
+        scores = np.zeros((n,), dtype=dtype)
+        words = np.zeros((n, max_step), dtype='int64')
+        lengths = np.zeros((n,), dtype='int64')
+        live = np.arange(n) # the rows that have not emitted the end token yet
+        xWa = np.matmul(np.matmul(z_emb[idx], params['C0']), params[_p(prefix, 'Wa')])
+        h = np.zeros((yUb.shape[0], n, params[_p(prefix, 'Ua')].shape[1]), dtype=dtype)
+        c = h
+        clock = _tick(profile, 'admission', clock)
+        for t in xrange(max_step):
+            _count(profile, 'n_rows', len(live))
+            cols, mask = None, None
+            if shortlist is not None:
+                cols, mask = _shortlist_cols(allowed[live])
+            tmp1 = _gate_dot(xWa * yWb[:, live], params[_p(prefix, 'WcT')])
+            clock = _tick(profile, 'input_projection', clock)
+            (y1, h, c) = _step_set(params, tmp1, h, c, yUb[:, live], cols, prefix, profile)
+            clock = time.time()
+            logp = _log_prob(y1, mask)
+            clock = _tick(profile, 'softmax', clock)
+            best = np.argmax(logp, axis=1)
+            clock = _tick(profile, 'topk', clock)
+            scores[live] += logp[np.arange(len(live)), best]
+            word = best if cols is None else cols[best]
+            words[live, t] = word
+            lengths[live] = t + 1
+
+            keep = word != 0
+            if not np.any(keep):
+                clock = _tick(profile, 'beam_bookkeeping', clock)
+                break
+            live, word, h, c = live[keep], word[keep], h[:, keep], c[:, keep]
+            xWa = params[_p(prefix, 'WembWa')][:, word]
+            clock = _tick(profile, 'beam_bookkeeping', clock)
+
+        _count(profile, 'n_images', n)
+        _count(profile, 'n_steps', int(np.sum(lengths)))
+        _count(profile, 'n_tokens', int(np.sum(lengths)))
+        for jj in xrange(n):
+            yield idx[jj], [(scores[jj], words[jj, :lengths[jj]].tolist())]
+
+def predict(z_emb, y_emb, params, beam_size, max_step, batch_size=1, refill=True, length_norm=0.,
+            shortlist=None, lattice=None, prefix='encoder_lstm', profile=None, step=None):
+
+    """ z_emb: size of (n_images, n_z), y_emb: size of (n_images, n_y)
+        params: the ensemble stacked by stack_params, every step evaluates all
+        members with one batched product per factor/gate.
+        Up to batch_size images are decoded together, each one in its own slot.
+        All live hypotheses of all slots are advanced together: their h/c are
+        stacked into (n_live, n_h) matrices, so every step is one matrix-matrix
+        product per factor/gate and one top-k per slot over its
+        (beam_size, n_words) score matrix.
+        Beams that emit the end token go to a pool of up to beam_size finished
+        hypotheses, ranked by log prob / length ** length_norm, and the beam is
+        refilled with live ones. An image is evicted as soon as no live beam can
+        beat its best finished one (or it reached max_step). With refill the
+        next pending image takes its slot at once, otherwise the slots are only
+        refilled when the whole block is done.
+        With a shortlist (see load_shortlist) the logits, softmax and top-k of
+        a step only cover the union of the candidate words of the active images,
+        and every row is restricted to the candidates of its own image.
+        A hypothesis only holds its node in the search history: the word, parent
+        node, log prob and image of every kept hypothesis go to preallocated
+        arrays, and the word ids of a caption are backtracked when its image is
+        done. Given a lattice dict, the history is left in it as the arrays
+        word, parent, score and image (see save_lattice).
+        Yields (image index, list of (log prob, word ids)) as images finish.
+        beam_size 1 without length_norm is plain greedy search, it goes to
+        predict_greedy (which keeps no lattice).
+        profile: dict the time of every stage and the numbers of images, steps,
+        hypothesis rows and caption tokens are added to, see generate
+        step: a Theano function of compile_step that does the LSTM step and the
+        ensemble softmax instead, it scores the full vocabulary
+    """
+    if beam_size == 1 and not length_norm and lattice is None and step is None:
+        for pred in predict_greedy(z_emb, y_emb, params, max_step, max(batch_size, 512), shortlist, prefix, profile):
+            yield pred
+        return
+
+    def _norm(score, length):
+        return score / length ** length_norm if length_norm else score
+
+    def _grow(a, size):
+        b = np.empty((size,), dtype=a.dtype)
+        b[:len(a)] = a
+        return b
+
+    def _words(node):
+        # backtrack the word ids of the hypothesis ending in node
+        words = []
+        while node >= 0:
+            words.append(int(hist_word[node]))
+            node = hist_parent[node]
+        return words[::-1]
+
+    n_images = z_emb.shape[0]
+    n_slots = min(batch_size, n_images)
+    n_models = params['bhid'].shape[0]
+    n_h = params[_p(prefix,'Ua')].shape[1]
+    n_f = params[_p(prefix,'Ua')].shape[2] // 4
+    n_words = params['bhid'].shape[1]
+    dtype = params['bhid'].dtype
+
+    # the tag modulations of the image in each slot, size of (n_models, n_slots, 4 * n_f)
+    yWb = np.zeros((n_models, n_slots, 4 * n_f), dtype=dtype)
+    yUb = np.zeros((n_models, n_slots, 4 * n_f), dtype=dtype)
+
+    # a hypothesis is (log prob, node in the history, length, row of its state in h_set/c_set),
+    # node -1 is the empty caption and row -1 the zero state
+    image = [-1] * n_slots # the image decoded in each slot, -1 for a free slot
+    nsteps = [0] * n_slots
+    beams = [[] for s in xrange(n_slots)]
+    finished = [[] for s in xrange(n_slots)]
+    h_set = np.zeros((n_models, 0, n_h), dtype=dtype)
+    c_set = np.zeros((n_models, 0, n_h), dtype=dtype)
+    pending = 0
+    n_nodes = 0
+    hist_word = np.zeros((1024,), dtype='int32')
+    hist_parent = np.zeros((1024,), dtype='int32')
+    hist_score = np.zeros((1024,), dtype=dtype)
+    hist_image = np.zeros((1024,), dtype='int32')
+    if shortlist is not None:
+        allowed = np.zeros((n_slots, n_words), dtype=bool) # the candidate words of each slot
+
     while True:
-        beam_candidates = []
-        for params in params_set:
-            params[_p(prefix, 'cacheH')].clear() #need to clear H cache at every step, but don't need for X
-        preStateId = 0
-        for b in beams:
-            ixprev = b[1][-1] if b[1] else 0 # start off with the word where this beam left off
-            if ixprev == 0 and b[1]:
-                # this beam predicted end token. Keep in the candidates but don't expand it out any more
-                beam_candidates.append(b)
-                continue
-            ihprev = b[4]
-            
-            h1_set = []
-            c1_set = []
-            p1 = 0.
-            for ii in range(num):
-                (y1, h1, c1) = _step_set(params['Wemb'][ixprev], b[2][ii], b[3][ii], ixprev, ihprev, params_set[ii])
-                h1_set.append(h1)
-                c1_set.append(c1)
-                y1 = y1.ravel() # make into 1D vector
-                maxy1 = np.amax(y1)
-                e1 = np.exp(y1 - maxy1) # for numerical stability shift into good numerical range
-                p1 = p1 + e1 / np.sum(e1)
-            
-            p1 = p1/num
-            y1 = np.log(1e-20 + p1) # and back to log domain
-            top_indices = np.argsort(-y1)  # we do -y because we want decreasing order
-
-            for i in xrange(beam_size):
-                wordix = top_indices[i]
-                beam_candidates.append((b[0] + y1[wordix], b[1] + [wordix], h1_set, c1_set, preStateId))
-
-            preStateId = preStateId + 1
-
-        beam_candidates.sort(reverse = True) # decreasing order
-        beams = beam_candidates[:beam_size] # truncate to get new beams
-        nsteps += 1
-        if nsteps >= max_step: # bad things are probably happening, break out
+        clock = time.time()
+        free = [s for s in xrange(n_slots) if image[s] < 0]
+        if pending < n_images and free and (refill or len(free) == n_slots):
+            new = free[:n_images - pending]
+            idx = range(pending, pending + len(new))
+            pending += len(new)
+            yWb[:, new] = np.matmul(y_emb[idx], params[_p(prefix, 'Wb')])
+            yUb[:, new] = np.matmul(y_emb[idx], params[_p(prefix, 'Ub')])
+            if shortlist is not None:
+                allowed[new] = image_shortlists(y_emb[idx], shortlist, n_words)
+                n_candidates = np.sum(allowed[new], axis=1)
+                shortlist['n_images'] += len(new)
+                shortlist['n_fallback'] += np.sum(n_candidates == n_words)
+                shortlist['n_candidates'] += np.sum(n_candidates)
+            for (s, i) in zip(new, idx):
+                # a new image starts from one empty hypothesis that is fed with the image feature
+                image[s] = i
+                nsteps[s] = 0
+                beams[s] = [(0., -1, 0, -1)]
+                finished[s] = []
+        clock = _tick(profile, 'admission', clock)
+
+        active = [s for s in xrange(n_slots) if image[s] >= 0]
+        if not active:
+            if lattice is not None:
+                lattice.update(word=hist_word[:n_nodes], parent=hist_parent[:n_nodes], score=hist_score[:n_nodes],
+                               image=hist_image[:n_nodes])
             break
 
-    # strip the intermediates, only keep ppl and wordids
-    predictions = [(b[0], b[1]) for b in beams]
+        live = [(s, j) for s in active for j in xrange(len(beams[s]))]
+        _count(profile, 'n_rows', len(live))
+        slot = np.array([s for (s, j) in live])
+        rows = np.array([beams[s][j][3] for (s, j) in live])
+        scores = np.array([beams[s][j][0] for (s, j) in live], dtype=dtype)
+        first = [jj for jj, (s, j) in enumerate(live) if beams[s][j][1] < 0]
+        rest = [jj for jj, (s, j) in enumerate(live) if beams[s][j][1] >= 0]
+        ixprev = hist_word[[beams[s][j][1] for (s, j) in (live[jj] for jj in rest)]] # start off with the word where each beam left off
+
+        # the words scored in this step, and which of them each row may use
+        cols, mask = None, None
+        if shortlist is not None and step is None:
+            cols, mask = _shortlist_cols(allowed[slot])
+        n_cols = n_words if cols is None else len(cols)
+
+        h_prev = np.concatenate((h_set, np.zeros((n_models, 1, n_h), dtype=dtype)), axis=1)[:, rows]
+        c_prev = np.concatenate((c_set, np.zeros((n_models, 1, n_h), dtype=dtype)), axis=1)[:, rows]
+        clock = _tick(profile, 'beam_bookkeeping', clock)
+        # calculate the prob. of next word using ensemble
+        if step is not None:
+            x = np.zeros((len(live),), dtype='int64')
+            x[rest] = ixprev
+            is_first = np.zeros((len(live),), dtype='int8')
+            is_first[first] = 1
+            img = [image[s] for s in slot]
+            allowed_words = allowed[slot] if shortlist is not None else np.ones((len(live), n_words), dtype=bool)
+            logp, h_set, c_set = step(h_prev, c_prev, x, is_first, z_emb[img], y_emb[img], allowed_words.view('int8'))
+            clock = _tick(profile, 'theano_step', clock)
+        else:
+            xWa = np.empty((n_models, len(live), 4 * n_f), dtype=dtype)
+            if first:
+                z0 = np.matmul(z_emb[[image[slot[jj]] for jj in first]], params['C0'])
+                xWa[:, first] = np.matmul(z0, params[_p(prefix, 'Wa')])
+            if rest:
+                xWa[:, rest] = params[_p(prefix, 'WembWa')][:, ixprev]
+            tmp1 = _gate_dot(xWa * yWb[:, slot], params[_p(prefix, 'WcT')])
+            clock = _tick(profile, 'input_projection', clock)
+            (y1, h_set, c_set) = _step_set(params, tmp1, h_prev, c_prev, yUb[:, slot], cols, prefix, profile)
+            clock = time.time()
+            logp = _log_prob(y1, mask)
+            clock = _tick(profile, 'softmax', clock)
+
+        # one top-k per slot over all its (beam, word) pairs, 2 * beam_size candidates
+        # are enough to refill the beam even if every live beam emitted the end token
+        pos = np.zeros((n_slots,), dtype='int64')
+        pos[active] = np.arange(len(active))
+        beam_of = np.array([j for (s, j) in live])
+        cand = np.empty((len(active), beam_size, n_cols), dtype=dtype)
+        cand.fill(-np.inf)
+        cand[pos[slot], beam_of] = scores[:, None] + logp
+        cand = cand.reshape((len(active), beam_size * n_cols))
+        k = min(2 * beam_size, beam_size * n_cols)
+        top_indices = np.argpartition(-cand, k - 1, axis=1)[:, :k]
+        top_scores = cand[np.arange(len(active))[:, None], top_indices]
+        order = np.argsort(-top_scores, axis=1) # decreasing order
+        top_indices = top_indices[np.arange(len(active))[:, None], order]
+        row_of = np.zeros((len(active), beam_size), dtype='int64')
+        row_of[pos[slot], beam_of] = np.arange(len(live))
+        clock = _tick(profile, 'topk', clock)
+
+        if n_nodes + len(active) * k > len(hist_word):
+            size = 2 * (n_nodes + len(active) * k)
+            hist_word, hist_parent = _grow(hist_word, size), _grow(hist_parent, size)
+            hist_score, hist_image = _grow(hist_score, size), _grow(hist_image, size)
+
+        done = []
+        for s in active:
+            beam_candidates = []
+            for t in top_indices[pos[s]]:
+                if np.isinf(cand[pos[s], t]) or len(beam_candidates) == beam_size:
+                    break
+                j, wordix = divmod(int(t), n_cols)
+                if cols is not None:
+                    wordix = int(cols[wordix])
+                hist_word[n_nodes] = wordix
+                hist_parent[n_nodes] = beams[s][j][1]
+                hist_score[n_nodes] = cand[pos[s], t]
+                hist_image[n_nodes] = image[s]
+                b = (cand[pos[s], t], n_nodes, nsteps[s] + 1, row_of[pos[s], j])
+                n_nodes += 1
+                if wordix == 0:
+                    # this beam predicted end token, move it to the pool and don't expand it out any more
+                    finished[s].append(b[:3])
+                else:
+                    beam_candidates.append(b)
+            finished[s].sort(key=lambda b: _norm(b[0], b[2]), reverse=True)
+            finished[s] = finished[s][:beam_size]
+            beams[s] = beam_candidates
+            nsteps[s] += 1
+
+            # stop once the pool holds beam_size captions and no live beam can beat the worst of them:
+            # log probs only decrease, so the best a live beam can reach is its current score spread
+            # over max_step words
+            if len(finished[s]) >= beam_size and beams[s]:
+                best_live = max(_norm(b[0], b[2] if not length_norm else max_step) for b in beams[s])
+                if best_live <= _norm(finished[s][-1][0], finished[s][-1][2]):
+                    beams[s] = []
 
-    return predictions
+            if not beams[s] or nsteps[s] >= max_step:
+                # strip the intermediates, only keep ppl and wordids
+                predictions = finished[s] + [b[:3] for b in beams[s]]
+                predictions.sort(key=lambda b: _norm(b[0], b[2]), reverse=True)
+                done.append((image[s], [(b[0], _words(b[1])) for b in predictions[:beam_size]]))
+                _count(profile, 'n_images', 1)
+                _count(profile, 'n_steps', nsteps[s])
+                _count(profile, 'n_tokens', len(done[-1][1][0][1]))
+                image[s] = -1
+                beams[s] = []
+        _tick(profile, 'beam_bookkeeping', clock)
 
-def generate(z_emb, y_emb, params_set, beam_size, max_step):
+        for pred in done:
+            yield pred
+
+def save_lattice(path, lattices, starts, index=None):
+
+    """ Save the search histories of predict as one lattice .npz: node n is
+        word[n] following node parent[n] (-1 for the start), with the log prob
+        score[n] of its caption so far, in the image image[n]. Nodes with word
+        0 end a caption.
+        lattices: the lattice dicts of shards of images, starting at starts
+        index: the image indexes of the decoded images, if not all of them
+    """
+    offsets = np.cumsum([0] + [len(lat['word']) for lat in lattices])
+    parent = [np.where(lat['parent'] >= 0, lat['parent'] + offset, -1) for lat, offset in zip(lattices, offsets)]
+    image = np.concatenate([lat['image'] + start for lat, start in zip(lattices, starts)])
+    if index is not None:
+        image = np.asarray(index)[image]
+    np.savez(path, word=np.concatenate([lat['word'] for lat in lattices]), parent=np.concatenate(parent).astype('int32'),
+             score=np.concatenate([lat['score'] for lat in lattices]), image=image.astype('int32'))
+
+def open_stream(path, header):
+
+    """ Read the captions streamed to path by generate and reopen it for
+        appending. A line cut off by a crash is dropped.
+        header: the key of the weights and decoding settings (see cache_key),
+            the first line of the file, a stream with another header is not resumed
+        Returns a dict from image key to its list of (log prob, word ids) and the file.
+    """
+    done = {}
+    size = 0
+    if os.path.exists(path):
+        lines = open(path, 'rb')
+        first = next(lines, '')
+        if first.endswith('\n'):
+            if json.loads(first).get('header') != header:
+                raise ValueError('%s was written with other weights or decoding settings, '
+                                 'remove it or stream to another file' % path)
+            size = len(first)
+            for line in lines:
+                if not line.endswith('\n'):
+                    break
+                record = json.loads(line)
+                done[unicode(record['image'])] = [(score, words) for score, words in record['captions']]
+                size += len(line)
+        lines.close()
+        if size < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+    out = open(path, 'ab')
+    if size == 0:
+        out.write(json.dumps({'header': header}) + '\n')
+        out.flush()
+
+    return done, out
+
+def cache_key(params_set, beam_size, max_step, length_norm=0., quantize_output=False, shortlist=None,
+              prefix='encoder_lstm'):
+
+    """ Hash of the weights of the ensemble and of every decoding setting that
+        changes the captions, the caption cache keys of its images start from it.
+        The decoding tables of prepare_params are left out, they follow from the weights.
+    """
+    tables = ['vWemb', 'vWemb_q', 'vWemb_scale', _p(prefix, 'WembWa'), _p(prefix, 'WcT'), _p(prefix, 'UcT')]
+    # an export made with --quantize-output is int8 whatever quantize_output says
+    quantized = [bool(quantize_output) or 'vWemb_q' in params for params in params_set]
+    h = hashlib.sha1(repr((beam_size, max_step, float(length_norm), quantized)))
+    arrays = [(kk, params[kk]) for params in params_set for kk in sorted(params) if kk not in tables]
+    if shortlist is not None:
+        h.update(repr((shortlist['n_tags'], shortlist['min_tag_prob'])))
+        arrays += [(kk, shortlist[kk]) for kk in ['frequent_words', 'tag_words']]
+    for kk, pp in arrays:
+        pp = np.ascontiguousarray(pp)
+        h.update(repr((kk, pp.dtype.str, pp.shape)))
+        h.update(pp)
+
+    return h.hexdigest()
+
+def image_cache_key(model_key, z, y):
+
+    """ Key of the captions of the image with features z and tags y """
+    h = hashlib.sha1(model_key)
+    for x in [z, y]:
+        x = np.ascontiguousarray(x)
+        h.update(x.dtype.str)
+        h.update(x)
+
+    return h.hexdigest()
+
+def _cache_file(path, key):
+    return os.path.join(path, key[:2], key[2:] + '.json')
+
+def cache_get(path, key):
+
+    """ Returns the cached list of (log prob, word ids) of key, or None.
+        A hit refreshes the time of the entry, which trim_cache evicts by.
+    """
+    name = _cache_file(path, key)
+    try:
+        captions = json.load(open(name, 'rb'))
+        os.utime(name, None)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return [(score, words) for score, words in captions]
+
+def cache_put(path, key, pred):
+    name = _cache_file(path, key)
+    if not os.path.isdir(os.path.dirname(name)):
+        os.makedirs(os.path.dirname(name))
+    # write to a temporary file first, a reader never sees half an entry
+    tmp = '%s.%d.tmp' % (name, os.getpid())
+    json.dump([(float(score), [int(w) for w in words]) for score, words in pred], open(tmp, 'wb'))
+    os.rename(tmp, name)
+
+def trim_cache(path, max_bytes):
+
+    """ Remove the least recently used entries until the cache takes at most max_bytes """
+    entries = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= max_bytes:
+            break
+        os.remove(name)
+        total -= size
+
+def share_params(params, path):
+
+    """ Save params under path and reopen them memory-mapped, so that worker
+        processes read one copy of the weights through the page cache.
+    """
+    if all(isinstance(pp, np.memmap) for pp in params.itervalues()):
+        return params
+    save_model(params, path)
+
+    return load_model(path)
+
+def limit_blas_threads(n_threads):
+
+    """ Cap the threads of the BLAS library numpy is linked against, for this
+        process and the ones it starts.
+    """
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+    # numpy has loaded its BLAS already, so also tell the library itself
+    if not os.path.exists('/proc/self/maps'):
+        return
+    for lib in set(line.split()[-1] for line in open('/proc/self/maps') if '.so' in line):
+        for name, func in [('openblas', 'openblas_set_num_threads'), ('mkl_rt', 'MKL_Set_Num_Threads')]:
+            if name in os.path.basename(lib):
+                try:
+                    getattr(ctypes.CDLL(lib), func)(n_threads)
+                except (OSError, AttributeError):
+                    pass
+
+# what the worker processes decode, inherited from the parent when they are forked
+_shard_args = {}
+
+def _decode_shard(bounds):
+    start, end = bounds
+    args = _shard_args
+    shortlist = dict(args['shortlist'], n_images=0, n_fallback=0, n_candidates=0) if args['shortlist'] is not None else None
+    lattice = {} if args['lattice'] else None
+    profile = {} if args['profile'] else None
+    predset = [None] * (end - start)
+    for i, pred in predict(args['z_emb'][start:end], args['y_emb'][start:end], args['params'], args['beam_size'],
+                           args['max_step'], args['batch_size'], args['refill'], args['length_norm'], shortlist,
+                           lattice, profile=profile, step=args['step']):
+        predset[i] = pred
+    return predset, shortlist, lattice, profile
+
+def write_profile(path, profile, seconds, extra):
+
+    """ Write the stage times and counts that predict added to profile, with
+        the throughput over seconds of wall time and the peak RSS, as a JSON
+        report. With worker processes the stage times are summed over them.
+        extra: more entries of the report
+    """
+    n_images = profile.get('n_images', 0)
+    seconds = max(seconds, 1e-9)
+    stages = dict((kk, vv) for kk, vv in profile.iteritems() if not kk.startswith('n_'))
+    total = max(sum(stages.values()), 1e-9)
+    usage = [resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    report = {
+        'seconds': seconds,
+        'images': n_images,
+        'images_per_sec': n_images / seconds,
+        'tokens_per_sec': profile.get('n_tokens', 0) / seconds,
+        'rows_per_sec': profile.get('n_rows', 0) / seconds,
+        'steps_per_image': profile.get('n_steps', 0) / float(max(n_images, 1)),
+        'stages': dict((kk, {'seconds': vv, 'share': vv / total}) for kk, vv in stages.iteritems()),
+        'peak_rss_mb': max(usage) / 1024., # ru_maxrss is in KB on linux
+    }
+    report.update(extra)
+    json.dump(report, open(path, 'w'), indent=1, sort_keys=True)
+
+    return report
+
+def generate(z_emb, y_emb, params_set, beam_size, max_step, batch_size=1, refill=True, length_norm=0.,
+             quantize_output=False, shortlist=None, workers=1, shard_size=100, lattice=None, stream=None, keys=None,
+             cache=None, cache_size=2**30, profile=None, theano_step=False):
+
+    """ batch_size: number of images decoded together
+        refill: give the slot of a finished image to the next pending one at once
+        length_norm: rank finished captions by log prob / length ** length_norm
+        quantize_output: use an int8 copy of the output projection
+        shortlist: restrict every image to its tag-driven candidate words, see load_shortlist
+        workers: number of processes decoding shards of shard_size images,
+            they share one memory-mapped copy of the weights
+        lattice: write the search lattice of all images to this .npz file
+        stream: append the captions of every image to this JSONL file as soon as
+            it is done, the images already in it are not decoded again; its first
+            line holds the key of the weights and settings, a stream of other ones is refused
+        keys: the key of every image in the stream, its index by default
+        cache: directory of captions keyed by the weights, decoding settings and
+            features of an image, images found in it are not decoded, least
+            recently used entries are removed beyond cache_size bytes
+        profile: time the stages of decoding and write a JSON report of them
+            and of the throughput to this file, see write_profile
+        theano_step: decode with the step of the training graph compiled by
+            Theano (see compile_step) instead of the NumPy one
+    """
+    generate_started = time.time()
+    predset = [None] * len(z_emb)
+    todo = range(len(z_emb))
+    if stream is not None or cache is not None:
+        model_key = cache_key(params_set, beam_size, max_step, length_norm, quantize_output, shortlist)
+    if stream is not None:
+        keys = keys if keys is not None else todo
+        done, out = open_stream(stream, model_key)
+        todo = [i for i in todo if unicode(keys[i]) not in done]
+        for i in xrange(len(z_emb)):
+            if unicode(keys[i]) in done:
+                predset[i] = done[unicode(keys[i])]
+        print 'resuming from %s: %d of %d images already decoded' % (stream, len(z_emb) - len(todo), len(z_emb))
+
+    def _write_stream(i, pred):
+        if stream is not None:
+            captions = [(float(score), [int(w) for w in words]) for score, words in pred]
+            out.write(json.dumps({'image': keys[i], 'captions': captions}) + '\n')
+            out.flush()
+
+    if cache is not None:
+        entry = dict((i, image_cache_key(model_key, z_emb[i], y_emb[i])) for i in todo)
+        n_todo = len(todo)
+        for i in todo:
+            predset[i] = cache_get(cache, entry[i])
+            if predset[i] is not None:
+                _write_stream(i, predset[i])
+        todo = [i for i in todo if predset[i] is None]
+        n_hits = n_todo - len(todo)
+        print 'caption cache: %d of %d images found in %s' % (n_hits, n_todo, cache)
+
+    def _write_report(prof, seconds, dtype):
+        extra = {'settings': {'beam_size': beam_size, 'max_step': max_step, 'batch_size': batch_size,
+                              'refill': refill, 'length_norm': length_norm, 'n_models': len(params_set),
+                              'dtype': str(dtype), 'quantize_output': quantize_output,
+                              'shortlist': shortlist is not None, 'workers': workers, 'theano_step': theano_step}}
+        if cache is not None:
+            extra['caption_cache'] = {'lookups': n_todo, 'hits': n_hits, 'hit_rate': n_hits / float(max(n_todo, 1))}
+        return write_profile(profile, prof, seconds, extra)
+
+    if not todo:
+        if stream is not None:
+            out.close()
+        if profile is not None:
+            # every image came from the stream or the cache, report the lookups
+            _write_report({}, time.time() - generate_started, compute_dtype(params_set[0]['bhid'].dtype))
+            print 'profile: no image decoded, written to %s' % profile
+        return predset
+    if len(todo) < len(z_emb):
+        z_emb, y_emb = z_emb[todo], y_emb[todo]
+
+    def _record(i, pred):
+        predset[todo[i]] = pred
+        _write_stream(todo[i], pred)
+        if cache is not None:
+            cache_put(cache, entry[todo[i]], pred)
 
-    predset = []
     print "count how many captions we have generated..."
-    prefix='encoder_lstm'
-    #params_set extension
-    params_set_ext = []
-    for params in params_set:
-        params['vWemb'] = np.dot(params['Vhid'],params['Wemb'].T)
-        params[_p(prefix, 'cacheX')] = OrderedDict()
-        params[_p(prefix, 'cacheH')] = OrderedDict()
-        params_set_ext.append(params)
-    del params_set
+    params = stack_params(prepare_params(params_set, quantize_output))
+    step = compile_step(params_set) if theano_step else None
      
     print 'start decoding @ ',
     print datetime.datetime.now().time()
-    for i in xrange(len(z_emb)):
-        y = y_emb[i]
-        params_set = []
-        for params in params_set_ext:        
-            params[_p(prefix, 'yWb_i')] = np.dot(y, params[_p(prefix, 'Wb_i')])
-            params[_p(prefix, 'yWb_f')] = np.dot(y, params[_p(prefix, 'Wb_f')])
-            params[_p(prefix, 'yWb_o')] = np.dot(y, params[_p(prefix, 'Wb_o')])
-            params[_p(prefix, 'yWb_c')] = np.dot(y, params[_p(prefix, 'Wb_c')])
-            params[_p(prefix, 'yUb_i')] = np.dot(y, params[_p(prefix, 'Ub_i')])
-            params[_p(prefix, 'yUb_f')] = np.dot(y, params[_p(prefix, 'Ub_f')])
-            params[_p(prefix, 'yUb_o')] = np.dot(y, params[_p(prefix, 'Ub_o')])
-            params[_p(prefix, 'yUb_c')] = np.dot(y, params[_p(prefix, 'Ub_c')])
-            params[_p(prefix, 'cacheX')].clear()
-            params[_p(prefix, 'cacheH')].clear()
-            params_set.append(params)
-
-        pred = predict(z_emb[i], params_set, beam_size, max_step)
-        predset.append(pred)
-        print '.',
+    started = time.time()
+    prof = {} if profile is not None else None
+    if workers > 1:
+        path = tempfile.mkdtemp(prefix='scn_decode_', dir='/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+        try:
+            _shard_args.update(z_emb=z_emb, y_emb=y_emb, params=share_params(params, path),
+                               beam_size=beam_size, max_step=max_step, batch_size=batch_size, refill=refill,
+                               length_norm=length_norm, shortlist=shortlist, lattice=lattice is not None,
+                               profile=profile is not None, step=step)
+            n_threads = max(1, multiprocessing.cpu_count() // workers)
+            pool = multiprocessing.Pool(workers, limit_blas_threads, (n_threads,))
+            shards = [(start, min(start + shard_size, len(z_emb))) for start in xrange(0, len(z_emb), shard_size)]
+            # imap keeps the order of the shards, so the captions come back in the order of the images
+            lattices = []
+            for (start, end), (pred, counts, lat, times) in zip(shards, pool.imap(_decode_shard, shards)):
+                for jj in xrange(end - start):
+                    _record(start + jj, pred[jj])
+                lattices.append(lat)
+                if profile is not None:
+                    for kk, vv in times.iteritems():
+                        prof[kk] = prof.get(kk, 0) + vv
+                if shortlist is not None:
+                    for kk in ['n_images', 'n_fallback', 'n_candidates']:
+                        shortlist[kk] += counts[kk]
+                print '.',
+            pool.close()
+            pool.join()
+            if lattice is not None:
+                save_lattice(lattice, lattices, [start for start, end in shards], todo)
+        finally:
+            _shard_args.clear()
+            shutil.rmtree(path)
+    else:
+        lat = {} if lattice is not None else None
+        for i, pred in predict(z_emb, y_emb, params, beam_size, max_step, batch_size, refill, length_norm,
+                               shortlist, lat, profile=prof, step=step):
+            _record(i, pred)
+            print '.',
+        if lattice is not None:
+            save_lattice(lattice, [lat], [0], todo)
+    seconds = time.time() - started
+    if stream is not None:
+        out.close()
+    if cache is not None:
+        trim_cache(cache, cache_size)
 
     print ' '
     print 'end @ ',
     print datetime.datetime.now().time()
+    if profile is not None:
+        report = _write_report(prof, seconds, params['bhid'].dtype)
+        print 'profile: %.2f images/sec, %.1f tokens/sec, %.1f steps per image, written to %s' % (
+            report['images_per_sec'], report['tokens_per_sec'], report['steps_per_image'], profile)
+    if shortlist is not None:
+        print 'shortlist: %.1f candidate words per image, %d of %d images used the full vocabulary' % (
+            shortlist['n_candidates'] / float(max(shortlist['n_images'], 1)), shortlist['n_fallback'], shortlist['n_images'])
 
     return predset
 
+def caption_agreement(predset, predset_ref):
+
+    """ Compare the best captions of two decodings of the same images, e.g.
+        float32 against float64. Returns the fraction of identical captions
+        and the mean absolute difference of their log probs.
+    """
+    same = [pred[0][1] == ref[0][1] for pred, ref in zip(predset, predset_ref)]
+    diff = [abs(pred[0][0] - ref[0][0]) for pred, ref in zip(predset, predset_ref)]
+
+    return np.mean(same), np.mean(diff)
 
 def check_args(args):
     parser = argparse.ArgumentParser()
@@ -218,52 +999,168 @@ def check_args(args):
         "--beam-size", help="Size of the decoding beam", type=int, default=1
     )
     parser.add_argument(
-        "--weights", help="Path to weights of trained model", required=True
+        "--weights", help="Path to weights of trained model, a .npz file or a --export-model directory",
+        required=True
+    )
+    parser.add_argument(
+        "--batch-size", help="Number of images decoded together", type=int, default=1
+    )
+    parser.add_argument(
+        "--static-batching",
+        help="Wait for the whole batch to finish instead of refilling the slots of finished images",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Append the captions of every image to this JSONL file as it is done, rerunning with it skips "
+             "the images already decoded",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Directory of captions keyed by weights, settings and image features, cached images are not decoded again",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size", help="Size limit of --cache in MB, least recently used captions go first", type=int, default=1024
+    )
+    parser.add_argument(
+        "--profile",
+        help="Time the decoding stages and write a JSON report of them and of the throughput to this file",
+        default=None,
+    )
+    parser.add_argument(
+        "--theano-step",
+        help="Decode with the LSTM step of the training graph compiled by Theano instead of the NumPy one",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lattice",
+        help="Write the search lattice of every image to this .npz file, for rescoring without decoding again",
+        default=None,
+    )
+    parser.add_argument(
+        "--export-model",
+        help="Save the weights with their decoding tables as memory-mappable .npy files to this directory and exit",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes decoding shards of the test images, sharing one copy of the weights",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--precision",
+        help="Float type of the decoder, float16 only stores the weights in half precision; "
+             "float64 by default, or the precision of an exported --weights directory",
+        choices=["float64", "float32", "float16"],
+        default=None,
+    )
+    parser.add_argument(
+        "--check-precision",
+        help="Also decode the first N images in float64 with the full output layer and report the caption agreement",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--quantize-output",
+        help="Use an int8 copy (one scale per word) of the output projection",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shortlist",
+        help="Vocabulary shortlist built by SCN_shortlist.py, restricts every image to its candidate words",
+    )
+    parser.add_argument(
+        "--shortlist-tags",
+        help="Number of top tags of an image whose associated words are candidates",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--shortlist-min-tag-prob",
+        help="Images without a tag of at least this probability use the full vocabulary",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        "--length-norm",
+        help="Rank finished captions by log prob / length ** length_norm (0 disables the normalization)",
+        type=float,
+        default=0.,
     )
 
     parsed_args = parser.parse_args(args)
+    if parsed_args.check_precision > 0 and os.path.isdir(parsed_args.weights):
+        parser.error("--check-precision needs the .npz weights as the float64 reference, not an exported directory")
     print(parsed_args)
     return parsed_args
 
 if __name__ == '__main__':
     parsed_args = check_args(sys.argv[1:])
 
+    if parsed_args.export_model:
+        export_model(load_params(parsed_args.weights, parsed_args.precision), parsed_args.export_model,
+                     parsed_args.quantize_output)
+        print 'model written to %s' % parsed_args.export_model
+        sys.exit(0)
+
     print "loading data..."
 
-    _, _, test_images_split = get_splits_from_occurrences_data(
-        parsed_args.occurrences_data, 0.1
-    )
+    split_index = load_split_index(parsed_args.occurrences_data, 0.1)
 
-    x = cPickle.load(open("./data/coco/data.p","rb"))
-    wordtoix, ixtoword = x[3], x[4]
-    del x
+    corpus = load_corpus("./data/coco/data.p")
+    wordtoix, ixtoword = corpus['wordtoix'], corpus['ixtoword']
     n_words = len(ixtoword)
 
-    data = scipy.io.loadmat('./data/coco/resnet_feats.mat')
-    img_feats = data['feats']
-
-    data = scipy.io.loadmat('./data/coco/tag_feats.mat')
-    tag_feats = data['feats']
+    img_feats = load_features('./data/coco/resnet_feats')
+    tag_feats = load_features('./data/coco/tag_feats')
 
     dataset = json.load(open('./data/coco/dataset.json', 'r'))
 
-    test_image_ids = []
-    coco_ids = []
-
-    for img in dataset['images']:
-        if unicode(img['cocoid']) in test_images_split:
-            test_image_ids.append(img['imgid'])
-            coco_ids.append(img['cocoid'])
+    splits = assign_splits([img['cocoid'] for img in dataset['images']], split_index)
+    test_images = [dataset['images'][i] for i in np.flatnonzero(splits == 2)]
+    test_image_ids = [img['imgid'] for img in test_images]
+    coco_ids = [img['cocoid'] for img in test_images]
     
-    z = img_feats[:,test_image_ids].T.astype('float64')
-    y = tag_feats[:,test_image_ids].T.astype('float64')
+    params_set = [load_params(parsed_args.weights, parsed_args.precision)]
+    precision = str(storage_dtype(params_set[0]))
+
+    # in the precision of the loaded weights, an exported model keeps its own
+    z = gather_features(img_feats, test_image_ids).astype(compute_dtype(precision), copy=False)
+    y = gather_features(tag_feats, test_image_ids).astype(compute_dtype(precision), copy=False)
     
     del img_feats, tag_feats
-    
-    params_set = [load_params(parsed_args.weights)]
+
+    shortlist = None
+    if parsed_args.shortlist:
+        shortlist = load_shortlist(parsed_args.shortlist, parsed_args.shortlist_tags,
+                                   parsed_args.shortlist_min_tag_prob)
 
     beam_size = parsed_args.beam_size
-    predset = generate(z, y, params_set, beam_size=beam_size, max_step=20)
+    predset = generate(z, y, params_set, beam_size=beam_size, max_step=20,
+                       batch_size=parsed_args.batch_size, refill=not parsed_args.static_batching,
+                       length_norm=parsed_args.length_norm, quantize_output=parsed_args.quantize_output,
+                       shortlist=shortlist, workers=parsed_args.workers, lattice=parsed_args.lattice,
+                       stream=parsed_args.stream, keys=coco_ids, cache=parsed_args.cache,
+                       cache_size=parsed_args.cache_size * 2**20, profile=parsed_args.profile,
+                       theano_step=parsed_args.theano_step)
+
+    if parsed_args.check_precision > 0:
+        n_check = parsed_args.check_precision
+        predset_ref = generate(z[:n_check].astype('float64'), y[:n_check].astype('float64'),
+                               [load_params(parsed_args.weights)], beam_size=beam_size, max_step=20,
+                               batch_size=parsed_args.batch_size, refill=not parsed_args.static_batching,
+                               length_norm=parsed_args.length_norm)
+        agreement, logprob_diff = caption_agreement(predset[:n_check], predset_ref)
+        name = precision
+        if parsed_args.quantize_output:
+            name += ' with int8 output'
+        if shortlist is not None:
+            name += ' with shortlist'
+        print '%s vs float64 on %d images: %.2f%% identical captions, mean |log prob diff| %.2e' % (
+            name, len(predset_ref), 100 * agreement, logprob_diff)
 
     generated_captions = []
     for top_k_sentences in predset:
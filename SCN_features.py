@@ -0,0 +1,79 @@
+'''
+Semantic Compositional Network https://arxiv.org/pdf/1611.08002.pdf
+Row-major, memory-mapped feature store, converted once from the .mat features
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+import scipy.io
+
+
+def convert_features(mat_file, npy_file, dtype='float32', chunk=10000):
+
+    """ Writes the features of mat_file, size of (dim, n_images), to npy_file
+        as (n_images, dim) rows in dtype, so row i holds the features of image i
+    """
+    feats = scipy.io.loadmat(mat_file)['feats']
+    dim, n_images = feats.shape
+    tmp = '%s.%d.tmp' % (npy_file, os.getpid())
+    store = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=(n_images, dim))
+    for start in xrange(0, n_images, chunk):
+        store[start:start + chunk] = feats[:, start:start + chunk].T
+    store.flush()
+    del store
+    os.rename(tmp, npy_file)
+
+def load_features(name):
+
+    """ Features of every image as rows, size of (n_images, dim). name.npy,
+        written by convert_features, is mapped instead of read; without it,
+        name.mat is loaded.
+    """
+    if os.path.exists(name + '.npy'):
+        return np.load(name + '.npy', mmap_mode='r')
+
+    return scipy.io.loadmat(name + '.mat')['feats'].T
+
+def gather_features(feats, idx, out=None):
+
+    """ The rows idx of feats, read into out[:len(idx)] when out is given
+    """
+    idx = np.asarray(idx, dtype='int64')
+    if out is None:
+        return np.take(feats, idx, axis=0)
+    out = out[:len(idx)]
+    if out.dtype == feats.dtype:
+        np.take(feats, idx, axis=0, out=out)
+    else:
+        out[:] = np.take(feats, idx, axis=0)
+
+    return out
+
+def check_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--features",
+        help="Feature files to convert, without the .mat extension, comma separated",
+        type=lambda s: s.split(','),
+        default=['./data/coco/resnet_feats', './data/coco/tag_feats',
+                 './data/coco/resnet_feats_test', './data/coco/tag_feats_test'],
+    )
+    parser.add_argument(
+        "--dtype", help="Precision of the stored features", default='float32'
+    )
+
+    parsed_args = parser.parse_args(args)
+    print(parsed_args)
+    return parsed_args
+
+if __name__ == '__main__':
+    parsed_args = check_args(sys.argv[1:])
+
+    for name in parsed_args.features:
+        if not os.path.exists(name + '.mat'):
+            print 'skip %s.mat, not found' % name
+            continue
+        print 'convert %s.mat to %s.npy...' % (name, name)
+        convert_features(name + '.mat', name + '.npy', parsed_args.dtype)
@@ -0,0 +1,148 @@
+'''
+Semantic Compositional Network https://arxiv.org/pdf/1611.08002.pdf
+Tag-driven vocabulary shortlist for SCN_decode.py --shortlist
+'''
+import argparse
+import cPickle
+import os
+import sys
+
+import numpy as np
+import scipy.io
+import scipy.sparse
+
+from SCN_training import load_split_index, assign_splits, get_coco_id_from_path
+from SCN_decode import image_shortlists
+
+
+def top_tags_of_images(tag_feats, n_tags, chunk=10000):
+
+    """ tag_feats: tag probabilities, size of (n_y, n_images)
+        Returns the n_tags most likely tags of every image, size of (n_images, n_tags)
+    """
+    n_images = tag_feats.shape[1]
+    top_tags = np.zeros((n_images, n_tags), dtype='int32')
+    for start in xrange(0, n_images, chunk):
+        feats = tag_feats[:, start:start + chunk].T
+        top_tags[start:start + chunk] = np.argsort(-feats, axis=1)[:, :n_tags]
+
+    return top_tags
+
+def build_shortlist(captions, image_idx, tag_feats, n_words, n_tags=10, words_per_tag=50, n_frequent=200):
+
+    """ captions: list of word id lists, image_idx: the column of tag_feats of each caption
+        Returns the n_frequent most frequent words and, for every tag, the
+        words_per_tag other words that occur most often in captions of images
+        where it is one of the top n_tags tags (padded with the end token).
+    """
+    n_caps = len(captions)
+    lengths = [len(s) for s in captions]
+    rows = np.repeat(np.arange(n_caps), lengths)
+    words = np.concatenate([np.asarray(s, dtype='int64') for s in captions])
+    word_inc = scipy.sparse.coo_matrix((np.ones(len(words)), (rows, words)), shape=(n_caps, n_words)).tocsr()
+    word_inc.data[:] = 1. # count every word once per caption
+
+    frequent_words = np.argsort(-np.asarray(word_inc.sum(axis=0)).ravel())[:n_frequent]
+
+    top_tags = top_tags_of_images(tag_feats, n_tags)[image_idx]
+    rows = np.repeat(np.arange(n_caps), n_tags)
+    tag_inc = scipy.sparse.coo_matrix((np.ones(rows.shape[0]), (rows, top_tags.ravel())),
+                                      shape=(n_caps, tag_feats.shape[0])).tocsr()
+
+    # co-occurrence counts of tags and words, size of (n_y, n_words)
+    counts = (tag_inc.T * word_inc).toarray()
+    counts[:, frequent_words] = 0
+    counts[:, 0] = 0
+    tag_words = np.argsort(-counts, axis=1)[:, :words_per_tag]
+    tag_words[counts[np.arange(counts.shape[0])[:, None], tag_words] == 0] = 0
+
+    return {'frequent_words': frequent_words.astype('int32'), 'tag_words': tag_words.astype('int32')}
+
+def shortlist_coverage(captions, image_idx, tag_feats, shortlist, n_words, chunk=5000):
+
+    """ Returns the share of caption tokens that are candidates of their image,
+        the share of captions whose tokens all are, the mean number of
+        candidates per caption and the share of captions using the full vocabulary.
+    """
+    n_tokens = n_covered = n_full_captions = n_candidates = n_fallback = 0
+    for start in xrange(0, len(captions), chunk):
+        idx = image_idx[start:start + chunk]
+        mask = image_shortlists(tag_feats[:, idx].T, shortlist, n_words)
+        for jj, s in enumerate(captions[start:start + chunk]):
+            covered = np.sum(mask[jj, s])
+            n_tokens += len(s)
+            n_covered += covered
+            n_full_captions += covered == len(s)
+        n_candidates += np.sum(mask)
+        n_fallback += np.sum(np.all(mask, axis=1))
+
+    n_caps = float(max(len(captions), 1))
+    return n_covered / float(max(n_tokens, 1)), n_full_captions / n_caps, n_candidates / n_caps, n_fallback / n_caps
+
+def check_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--occurrences-data",
+        help="File containing occurrences statistics about adjective noun pairs",
+        required=True,
+    )
+    parser.add_argument(
+        "--top-tags", help="Number of top tags of an image its caption words are counted for", type=int, default=10
+    )
+    parser.add_argument(
+        "--words-per-tag", help="Number of candidate words kept for every tag", type=int, default=50
+    )
+    parser.add_argument(
+        "--frequent-words", help="Number of most frequent words that are always candidates", type=int, default=200
+    )
+    parser.add_argument(
+        "--min-tag-prob",
+        help="Images without a tag of at least this probability use the full vocabulary (coverage report only)",
+        type=float,
+        default=0.2,
+    )
+
+    parsed_args = parser.parse_args(args)
+    print(parsed_args)
+    return parsed_args
+
+if __name__ == '__main__':
+    parsed_args = check_args(sys.argv[1:])
+
+    print "loading data..."
+
+    split_index = load_split_index(parsed_args.occurrences_data, 0.1)
+
+    x = cPickle.load(open("./data/coco/data.p","rb"))
+    wordtoix, ixtoword = x[3], x[4]
+    n_words = len(ixtoword)
+
+    # learn from the captions of the training images only, so no held-out pair leaks in
+    train_caps, train_idx, val_caps, val_idx = [], [], [], []
+    for split in x[:3]:
+        splits = assign_splits([get_coco_id_from_path(path) for path in split[2]], split_index)
+        for i in np.flatnonzero(splits == 0):
+            train_caps.append(split[0][i])
+            train_idx.append(split[1][i])
+        for i in np.flatnonzero(splits == 1):
+            val_caps.append(split[0][i])
+            val_idx.append(split[1][i])
+    del x
+
+    data = scipy.io.loadmat('./data/coco/tag_feats.mat')
+    tag_feats = data['feats']
+
+    print 'building the shortlist from %d captions...' % len(train_caps)
+    shortlist = build_shortlist(train_caps, np.array(train_idx), tag_feats, n_words, n_tags=parsed_args.top_tags,
+                                words_per_tag=parsed_args.words_per_tag, n_frequent=parsed_args.frequent_words)
+
+    shortlist.update({'n_tags': parsed_args.top_tags, 'min_tag_prob': parsed_args.min_tag_prob})
+    token_cov, caption_cov, n_candidates, fallback = shortlist_coverage(val_caps, np.array(val_idx), tag_feats,
+                                                                        shortlist, n_words)
+    print 'validation coverage: %.2f%% of tokens, %.2f%% of captions fully covered' % (100 * token_cov, 100 * caption_cov)
+    print '%.1f candidate words per image, %.2f%% of images use the full vocabulary' % (n_candidates, 100 * fallback)
+
+    split_name = os.path.basename(parsed_args.occurrences_data).split(".")[0]
+    name = "shortlist_{}.npz".format(split_name)
+    print 'write shortlist to %s' % name
+    np.savez(name, frequent_words=shortlist['frequent_words'], tag_words=shortlist['tag_words'])
@@ -9,15 +9,19 @@ import sys
 import time
 import logging
 import cPickle
+import itertools
+import shutil
+import threading
+import Queue
 
 import numpy as np
-import scipy.io
 import theano
 import theano.tensor as tensor
 
 from model_scn.img_cap import init_params, init_tparams, build_model
 from model_scn.optimizers import Adam
-from model_scn.utils import get_minibatches_idx, zipp, unzip
+from SCN_features import load_features, gather_features
+from model_scn.utils import get_minibatches_idx, get_bucketed_minibatches_idx, padding_ratio, zipp, unzip
 
 # Set the random number generators' seeds for consistency
 SEED = 123  
@@ -48,34 +52,191 @@ def get_splits_from_occurrences_data(occurrences_data_file, val_set_size=0.0):
 
     return train_images_split, val_images_split, test_images_split
 
+def load_split_index(occurrences_data_file, val_set_size=0.0):
+
+    """ Integer coco ids of the train, val and test images of
+        get_splits_from_occurrences_data, in its order. The ids are cached
+        next to occurrences_data_file, and rebuilt when the file changes.
+    """
+    stat = os.stat(occurrences_data_file)
+    stamp = np.array([stat.st_size, stat.st_mtime, val_set_size])
+    name = '{}.splits_{}.npz'.format(os.path.splitext(occurrences_data_file)[0], val_set_size)
+    if os.path.exists(name):
+        index = np.load(name)
+        if np.array_equal(index['stamp'], stamp):
+            return index['train'], index['val'], index['test']
+
+    splits = get_splits_from_occurrences_data(occurrences_data_file, val_set_size)
+    train, val, test = [np.array([int(key) for key in split], dtype='int64') for split in splits]
+    tmp = '%s.%d.tmp' % (name, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, stamp=stamp, train=train, val=val, test=test)
+    os.rename(tmp, name)
+
+    return train, val, test
+
+def assign_splits(coco_ids, split_index):
+
+    """ split_index: coco ids of the train, val and test images, see load_split_index
+        Returns the split of every coco id, 0 for train, 1 for val, 2 for test
+        and -1 for images in none of them
+    """
+    coco_ids = np.asarray(coco_ids, dtype='int64')
+    n_ids = max([coco_ids.max() if coco_ids.size else 0] + [ids.max() for ids in split_index if ids.size]) + 1
+    lookup = np.empty(n_ids, dtype='int8')
+    lookup.fill(-1)
+    for split in reversed(range(len(split_index))):
+        lookup[split_index[split]] = split
+
+    return lookup[coco_ids]
+
 def get_coco_id_from_path(path):
     return int(path.split("_")[2].split(".")[0])
 
-def prepare_data(seqs):
+def load_corpus(data_file):
+
+    """ The captions of the train, val and test sets of data_file (data.p) as
+        one int32 token array, the captions starting at offsets[:-1], with the
+        feature column and coco id of each caption and the vocabulary. The
+        arrays are written next to data_file on first use, and mapped.
+    """
+    stat = os.stat(data_file)
+    stamp = np.array([stat.st_size, stat.st_mtime])
+    corpus_dir = os.path.splitext(data_file)[0] + '_corpus'
+    names = ['tokens', 'offsets', 'images', 'coco_ids']
+    if not (os.path.exists(os.path.join(corpus_dir, 'stamp.npy')) and
+            np.array_equal(np.load(os.path.join(corpus_dir, 'stamp.npy')), stamp)):
+        x = cPickle.load(open(data_file, 'rb'))
+        captions = [s for split in x[:3] for s in split[0]]
+        offsets = np.zeros(len(captions) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(s) for s in captions])
+        arrays = {
+            'tokens': np.fromiter(itertools.chain.from_iterable(captions), dtype='int32', count=offsets[-1]),
+            'offsets': offsets,
+            'images': np.array([i for split in x[:3] for i in split[1]], dtype='int32'),
+            'coco_ids': np.array([get_coco_id_from_path(path) for split in x[:3] for path in split[2]],
+                                 dtype='int64'),
+        }
+        tmp = '%s.%d.tmp' % (corpus_dir, os.getpid())
+        os.mkdir(tmp)
+        for name in names:
+            np.save(os.path.join(tmp, name + '.npy'), arrays[name])
+        cPickle.dump((x[3], x[4]), open(os.path.join(tmp, 'vocab.p'), 'wb'), -1)
+        np.save(os.path.join(tmp, 'stamp.npy'), stamp)
+        del x, captions, arrays
+        if os.path.exists(corpus_dir):
+            shutil.rmtree(corpus_dir)
+        os.rename(tmp, corpus_dir)
+
+    corpus = dict((name, np.load(os.path.join(corpus_dir, name + '.npy'), mmap_mode='r')) for name in names)
+    corpus['wordtoix'], corpus['ixtoword'] = cPickle.load(open(os.path.join(corpus_dir, 'vocab.p'), 'rb'))
+
+    return corpus
+
+def corpus_split(corpus, rows):
+
+    """ The captions rows of corpus as (tokens, starts, lengths, images),
+        the data of train_model and calu_negll
+    """
+    rows = np.asarray(rows)
+    starts = np.asarray(corpus['offsets'][rows])
+    lengths = np.asarray(corpus['offsets'][rows + 1]) - starts
+
+    return corpus['tokens'], starts, lengths, np.asarray(corpus['images'][rows])
+
+def prepare_data(tokens, starts, lengths):
     
-    # x: a list of sentences
-    lengths = [len(s) for s in seqs]
-    n_samples = len(seqs)
+    # the captions tokens[starts[i]:starts[i] + lengths[i]], padded to the longest
     maxlen = np.max(lengths)
+    steps = np.arange(maxlen)[:, None]
+    x_mask = steps < lengths[None, :]
+
+    x = np.zeros((maxlen, len(lengths)), dtype='int64')
+    x[x_mask] = tokens[(starts[None, :] + steps)[x_mask]]
+
+    return x, x_mask.astype(theano.config.floatX)
 
-    x = np.zeros((maxlen, n_samples)).astype('int64')
-    x_mask = np.zeros((maxlen, n_samples)).astype(theano.config.floatX)
-    for idx, s in enumerate(seqs):
-        x[:lengths[idx], idx] = s
-        x_mask[:lengths[idx], idx] = 1.
+def iterate_minibatches(prepare_data, data, img_feats, tag_feats, iterator, n_prefetch=2, stats=None):
 
-    return x, x_mask
+    """ Yields (x, mask, y, z) of the minibatches of iterator. With n_prefetch,
+        a thread prepares up to n_prefetch minibatches ahead while the caller
+        works on the current one. stats: dict, 'wait' adds up the seconds the
+        caller waited for a minibatch and 'batches' counts them.
+        y and z are views of reused buffers, valid until the next minibatch.
+    """
+    n_batch = max(len(index) for _, index in iterator)
+    # one buffer being filled, n_prefetch queued and one in use
+    n_buf = n_prefetch + 2 if n_prefetch > 0 else 1
+    y_bufs = [np.empty((n_batch, tag_feats.shape[1]), dtype=theano.config.floatX) for _ in xrange(n_buf)]
+    z_bufs = [np.empty((n_batch, img_feats.shape[1]), dtype=theano.config.floatX) for _ in xrange(n_buf)]
+
+    def prepare(k, index):
+        x, mask = prepare_data(data[0], data[1][index], data[2][index])
+        y = gather_features(tag_feats, data[3][index], y_bufs[k % n_buf])
+        z = gather_features(img_feats, data[3][index], z_bufs[k % n_buf])
+        return x, mask, y, z
+
+    if stats is None:
+        stats = {}
+    stats.setdefault('wait', 0.)
+    stats.setdefault('batches', 0)
+
+    if n_prefetch <= 0:
+        for k, (_, index) in enumerate(iterator):
+            clock = time.time()
+            batch = prepare(k, index)
+            stats['wait'] += time.time() - clock
+            stats['batches'] += 1
+            yield batch
+        return
+
+    queue = Queue.Queue(n_prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for k, (_, index) in enumerate(iterator):
+                item = (None, prepare(k, index))
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = (None, None)
+        except Exception:
+            item = (sys.exc_info(), None)
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            clock = time.time()
+            error, batch = queue.get()
+            stats['wait'] += time.time() - clock
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if batch is None:
+                break
+            stats['batches'] += 1
+            yield batch
+    finally:
+        stop.set()
 
-def calu_negll(f_cost, prepare_data, data, img_feats, tag_feats, iterator):
+def calu_negll(f_cost, prepare_data, data, img_feats, tag_feats, iterator, n_prefetch=2):
 
     totalcost = 0.
     totallen = 0.
-    for _, valid_index in iterator:
-        x = [data[0][t]for t in valid_index]
-        x, mask = prepare_data(x)
-        y = np.array([tag_feats[:,data[1][t]]for t in valid_index])
-        z = np.array([img_feats[:,data[1][t]]for t in valid_index])
-                
+    for x, mask, y, z in iterate_minibatches(prepare_data, data, img_feats, tag_feats, iterator, n_prefetch):
         length = np.sum(mask)
         cost = f_cost(x, mask,y,z) * x.shape[1]
         totalcost += cost
@@ -87,10 +248,11 @@ def calu_negll(f_cost, prepare_data, data, img_feats, tag_feats, iterator):
 
 def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=300, n_h=512,
     n_f = 512, max_epochs=20, lrate=0.0002, batch_size=64, valid_batch_size=64, 
-    dropout_val=0.5, dispFreq=100, validFreq=500, saveFreq=1000,
-    saveto = 'coco_result_scn.npz'):
+    dropout_val=0.5, dispFreq=100, validFreq=500, saveFreq=1000, bucket_size=20, exact_epoch=True,
+    prefetch=2, saveto = 'coco_result_scn.npz'):
         
-    """ n_words : vocabulary size
+    """ train, valid, test : (tokens, starts, lengths, images) of the captions, see corpus_split
+        n_words : vocabulary size
         n_x : word embedding dimension
         n_h : LSTM/GRU number of hidden units 
         n_f : number of factors
@@ -102,6 +264,11 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
         dispFreq : Display to stdout the training progress every N updates
         validFreq : Compute the validation error after this number of update.
         saveFreq : save results after this number of update.
+        bucket_size : train on minibatches of captions of similar length, from
+            buckets of this many minibatches; 0 shuffles uniformly
+        exact_epoch : with bucket_size, see every caption once per epoch,
+            otherwise drop the last, smaller minibatch
+        prefetch : number of minibatches prepared ahead by a thread; 0 prepares them in turn
         saveto : where to save.
     """
 
@@ -117,15 +284,17 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
     options['dispFreq'] = dispFreq
     options['validFreq'] = validFreq
     options['saveFreq'] = saveFreq
+    options['bucket_size'] = bucket_size
+    options['prefetch'] = prefetch
     
-    options['n_z'] = img_feats.shape[0]
-    options['n_y'] = tag_feats.shape[0]
+    options['n_z'] = img_feats.shape[1]
+    options['n_y'] = tag_feats.shape[1]
     options['SEED'] = SEED
 
     logger.info('Model options {}'.format(options))
-    logger.info('{} train examples'.format(len(train[0])))
-    logger.info('{} valid examples'.format(len(valid[0])))
-    logger.info('{} test examples'.format(len(test[0])))
+    logger.info('{} train examples'.format(len(train[2])))
+    logger.info('{} valid examples'.format(len(valid[2])))
+    logger.info('{} test examples'.format(len(test[2])))
 
     logger.info('Building model...')
     
@@ -141,8 +310,27 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
 
     logger.info('Training model...')
 
-    kf_valid = get_minibatches_idx(len(valid[0]), valid_batch_size)
-    kf_test = get_minibatches_idx(len(test[0]), valid_batch_size)
+    # the negll does not depend on the batch composition, so evaluate on length-sorted batches
+    train_lengths = train[2]
+    valid_lengths = valid[2]
+    kf_valid = get_bucketed_minibatches_idx(valid_lengths, valid_batch_size)
+    kf_test = get_bucketed_minibatches_idx(test[2], valid_batch_size)
+
+    # leave the random state as it was, so the report does not change the training batches
+    state = np.random.get_state()
+    uniform_padding = padding_ratio(train_lengths, get_minibatches_idx(len(train[2]), batch_size, shuffle=True))
+    if bucket_size > 0:
+        bucketed_padding = padding_ratio(train_lengths, get_bucketed_minibatches_idx(
+            train_lengths, batch_size, shuffle=True, bucket_size=bucket_size, exact=exact_epoch))
+    np.random.set_state(state)
+    if bucket_size > 0:
+        logger.info('Train padding {:.1%} shuffled, {:.1%} in length buckets'.format(uniform_padding,
+                                                                                    bucketed_padding))
+    else:
+        logger.info('Train padding {:.1%} shuffled'.format(uniform_padding))
+    logger.info('Valid padding {:.1%} unsorted, {:.1%} length-sorted'.format(
+        padding_ratio(valid_lengths, get_minibatches_idx(len(valid[2]), valid_batch_size)),
+        padding_ratio(valid_lengths, kf_valid)))
     
     estop = False  # early stop
     history_negll = []
@@ -153,18 +341,19 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
     
     try:
         for eidx in xrange(max_epochs):
-            kf = get_minibatches_idx(len(train[0]), batch_size, shuffle=True)
-
-            for _, train_index in kf:
+            if bucket_size > 0:
+                kf = get_bucketed_minibatches_idx(train_lengths, batch_size, shuffle=True,
+                                                  bucket_size=bucket_size, exact=exact_epoch)
+            else:
+                kf = get_minibatches_idx(len(train[2]), batch_size, shuffle=True)
+
+            epoch_start = time.time()
+            data_stats = {}
+            for x, mask, y, z in iterate_minibatches(prepare_data, train, img_feats, tag_feats, kf, prefetch,
+                                                     data_stats):
                 uidx += 1
                 use_noise.set_value(dropout_val)
 
-                x = [train[0][t]for t in train_index]
-                y = np.array([tag_feats[:,train[1][t]]for t in train_index])
-                z = np.array([img_feats[:,train[1][t]]for t in train_index])
-                
-                x, mask = prepare_data(x)
-
                 cost = f_grad_shared(x, mask,y,z)
                 f_update(lrate)
 
@@ -189,8 +378,8 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
                     use_noise.set_value(0.)
                     
                     #train_negll = calu_negll(f_cost, prepare_data, train, img_feats, kf)
-                    valid_negll = calu_negll(f_cost, prepare_data, valid, img_feats, tag_feats, kf_valid)
-                    test_negll = calu_negll(f_cost, prepare_data, test, img_feats, tag_feats, kf_test)
+                    valid_negll = calu_negll(f_cost, prepare_data, valid, img_feats, tag_feats, kf_valid, prefetch)
+                    test_negll = calu_negll(f_cost, prepare_data, test, img_feats, tag_feats, kf_test, prefetch)
                     history_negll.append([valid_negll, test_negll])
                     
                     if (uidx == 0 or
@@ -209,6 +398,9 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
                                 estop = True
                                 break
 
+            logger.info('Epoch {} waited {:.1f} sec for {} minibatches, {:.1%} of the epoch'.format(
+                eidx, data_stats['wait'], data_stats['batches'], data_stats['wait'] / (time.time() - epoch_start)))
+
             if estop:
                 break
 
@@ -223,10 +415,10 @@ def train_model(train, valid, test, img_feats, tag_feats, W, n_words=8791, n_x=3
         best_p = unzip(tparams)
         
     use_noise.set_value(0.)
-    #kf_train_sorted = get_minibatches_idx(len(train[0]), batch_size)
+    #kf_train_sorted = get_minibatches_idx(len(train[2]), batch_size)
     #train_negll = calu_negll(f_cost, prepare_data, train, img_feats, kf_train_sorted)
-    valid_negll = calu_negll(f_cost, prepare_data, valid, img_feats, tag_feats, kf_valid)
-    test_negll = calu_negll(f_cost, prepare_data, test, img_feats, tag_feats, kf_test)
+    valid_negll = calu_negll(f_cost, prepare_data, valid, img_feats, tag_feats, kf_valid, prefetch)
+    test_negll = calu_negll(f_cost, prepare_data, test, img_feats, tag_feats, kf_test, prefetch)
     
     logger.info('Final Results...')
     logger.info('Perp: Valid {} Test {}'.format(np.exp(valid_negll), np.exp(test_negll)))
@@ -245,6 +437,24 @@ def check_args(args):
         help="File containing occurrences statistics about adjective noun pairs",
         required=True,
     )
+    parser.add_argument(
+        "--bucket-size",
+        help="Train on minibatches of captions of similar length, from buckets of this many minibatches; "
+             "0 shuffles uniformly",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--drop-last",
+        help="Drop the last, smaller minibatch of every epoch instead of seeing every caption once",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of minibatches a thread prepares ahead of the updates; 0 prepares them in turn",
+        type=int,
+        default=2,
+    )
 
     parsed_args = parser.parse_args(args)
     print(parsed_args)
@@ -267,91 +477,30 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     logger.addHandler(fh)
     
-    x = cPickle.load(open("./data/coco/data.p","rb"))
-    train, val, test = x[0], x[1], x[2]
-    wordtoix, ixtoword = x[3], x[4]
-    del x
-    n_words = len(ixtoword)
+    # the captions of data.p as flat arrays, converted on the first run
+    corpus = load_corpus("./data/coco/data.p")
+    n_words = len(corpus['ixtoword'])
     
     x = cPickle.load(open("./data/coco/word2vec.p","rb"))
     W = x[0]
     del x
 
-    train_images_split, val_images_split, test_images_split = get_splits_from_occurrences_data(
-        parsed_args.occurrences_data, 0.1
-    )
+    # regroup the captions of all three data.p sets by the split of their image
+    splits = assign_splits(corpus['coco_ids'], load_split_index(parsed_args.occurrences_data, 0.1))
+    train, val, test = [corpus_split(corpus, np.flatnonzero(splits == split)) for split in range(3)]
 
-    new_train_0 = []
-    new_train_1 = []
-    new_train_2 = []
-    new_val_0 = []
-    new_val_1 = []
-    new_val_2 = []
-    new_test_0 = []
-    new_test_1 = []
-    new_test_2 = []
-
-    for i in range(len(train[2])):
-        coco_id = unicode(get_coco_id_from_path(train[2][i]))
-        if coco_id in train_images_split:
-            new_train_0.append(train[0][i])
-            new_train_1.append(train[1][i])
-            new_train_2.append(train[2][i])
-        elif coco_id in val_images_split:
-            new_val_0.append(train[0][i])
-            new_val_1.append(train[1][i])
-            new_val_2.append(train[2][i])
-        elif coco_id in test_images_split:
-            new_test_0.append(train[0][i])
-            new_test_1.append(train[1][i])
-            new_test_2.append(train[2][i])
-
-    for i in range(len(val[2])):
-        coco_id = unicode(get_coco_id_from_path(val[2][i]))
-        if coco_id in train_images_split:
-            new_train_0.append(val[0][i])
-            new_train_1.append(val[1][i])
-            new_train_2.append(val[2][i])
-        elif coco_id in val_images_split:
-            new_val_0.append(val[0][i])
-            new_val_1.append(val[1][i])
-            new_val_2.append(val[2][i])
-        elif coco_id in test_images_split:
-            new_test_0.append(val[0][i])
-            new_test_1.append(val[1][i])
-            new_test_2.append(val[2][i])
-
-    for i in range(len(test[2])):
-        coco_id = unicode(get_coco_id_from_path(test[2][i]))
-        if coco_id in train_images_split:
-            new_train_0.append(test[0][i])
-            new_train_1.append(test[1][i])
-            new_train_2.append(test[2][i])
-        elif coco_id in val_images_split:
-            new_val_0.append(test[0][i])
-            new_val_1.append(test[1][i])
-            new_val_2.append(test[2][i])
-        elif coco_id in test_images_split:
-            new_test_0.append(test[0][i])
-            new_test_1.append(test[1][i])
-            new_test_2.append(test[2][i])
-
-    train = (new_train_0, new_train_1, new_train_2)
-    val = (new_val_0, new_val_1, new_val_2)
-    test = (new_test_0, new_test_1, new_test_2)
-
-    logger.info('Train set size {}'.format(len(train[0])))
-    logger.info('Val set size {}'.format(len(val[0])))
-    logger.info('Test set size {}'.format(len(test[0])))
-
-
-    data = scipy.io.loadmat('./data/coco/resnet_feats.mat')
-    img_feats = data['feats'].astype(theano.config.floatX)
-    
-    data = scipy.io.loadmat('./data/coco/tag_feats.mat')
-    tag_feats = data['feats'].astype(theano.config.floatX)
+    logger.info('Train set size {}'.format(len(train[2])))
+    logger.info('Val set size {}'.format(len(val[2])))
+    logger.info('Test set size {}'.format(len(test[2])))
+
+
+    # rows of the images, mapped from the .npy files of SCN_features.py when they exist
+    img_feats = load_features('./data/coco/resnet_feats')
+    tag_feats = load_features('./data/coco/tag_feats')
 
     name = os.path.basename(parsed_args.occurrences_data).split(".")[0]
     [val_negll, te_negll] = train_model(train, val, test, img_feats, tag_feats, W,
-        n_words=n_words, saveto = 'weights_{}.npz'.format(name))
+        n_words=n_words, bucket_size=parsed_args.bucket_size, exact_epoch=not parsed_args.drop_last,
+        prefetch=parsed_args.prefetch,
+        saveto = 'weights_{}.npz'.format(name))
         
@@ -8,9 +8,9 @@ from collections import OrderedDict
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from utils import dropout, numpy_floatX
-from utils import uniform_weight, zero_bias
+from utils import uniform_weight, zero_bias, _p
 
-from lstm_layers import param_init_encoder, encoder_layer
+from lstm_layers import param_init_encoder, encoder_layer, encoder_input, encoder_step
 
 # Set the random number generators' seeds for consistency
 #SEED = 123  
@@ -105,3 +105,27 @@ def build_model(tparams,options):
     cost = -tensor.log(pred_word + 1e-6).sum() / n_samples  
     
     return use_noise, x, mask, y, z, cost
+
+""" One decoding step of the model, for beam search. """
+
+def build_step(tparams, h, c, x, first, z, y, prefix='encoder_lstm'):
+    
+    """ Advance a batch of hypotheses by one word with the layers of build_model.
+        h, c: size of n_samples * n_h, x: the previous word of every sample,
+        the samples with first = 1 are fed the image features z instead,
+        y: size of n_samples * n_y
+        Returns the logits of the next word, size of n_samples * n_words, and the new h, c
+    """
+    emb = tparams['Wemb'][x]
+    z0 = tensor.dot(z, tparams['C0'])
+    emb_input = tensor.switch(first.dimshuffle(0,'x'), z0, emb)
+    
+    state_below_ = encoder_input(tparams, emb_input, y, prefix)
+    yUb = tensor.dot(y, tparams[_p(prefix, 'Ub')])
+    h, c = encoder_step(state_below_, h, c, tparams[_p(prefix, 'Ua')], tparams[_p(prefix, 'Uc')], yUb)
+    
+    # the decoder may pass the product of Vhid and Wemb.T precomputed
+    Vhid = tparams['vWemb'] if 'vWemb' in tparams else tensor.dot(tparams['Vhid'],tparams['Wemb'].T)
+    pred_x = tensor.dot(h, Vhid) + tparams['bhid']
+    
+    return pred_x, h, c
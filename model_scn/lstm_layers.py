@@ -1,5 +1,5 @@
 
-#import numpy as np
+import numpy as np
 import theano
 import theano.tensor as tensor
 from utils import _p, numpy_floatX
@@ -9,48 +9,89 @@ from utils import uniform_weight, zero_bias
 
 def param_init_encoder(options, params, prefix='encoder_lstm'):
     
+    """ The weights of the i/f/o/c gates are stacked along the factor axis,
+        e.g. Wa is [Wa_i, Wa_f, Wa_o, Wa_c] of size n_x * (4*n_f), so each
+        product is one large GEMM instead of four small ones.
+    """
     n_x = options['n_x']
     n_h = options['n_h']
     n_f = options['n_f']
     n_y = options['n_y']
     
-    params[_p(prefix, 'Wa_i')] = uniform_weight(n_x,n_f)
-    params[_p(prefix, 'Wa_f')] = uniform_weight(n_x,n_f)
-    params[_p(prefix, 'Wa_o')] = uniform_weight(n_x,n_f)
-    params[_p(prefix, 'Wa_c')] = uniform_weight(n_x,n_f)
-    
-    params[_p(prefix, 'Wb_i')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Wb_f')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Wb_o')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Wb_c')] = uniform_weight(n_y,n_f)
-    
-    params[_p(prefix, 'Wc_i')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Wc_f')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Wc_o')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Wc_c')] = uniform_weight(n_h,n_f)
-    
-    params[_p(prefix, 'Ua_i')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Ua_f')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Ua_o')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Ua_c')] = uniform_weight(n_h,n_f)
-    
-    params[_p(prefix, 'Ub_i')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Ub_f')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Ub_o')] = uniform_weight(n_y,n_f)
-    params[_p(prefix, 'Ub_c')] = uniform_weight(n_y,n_f)
-    
-    params[_p(prefix, 'Uc_i')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Uc_f')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Uc_o')] = uniform_weight(n_h,n_f)
-    params[_p(prefix, 'Uc_c')] = uniform_weight(n_h,n_f)
-    
-    params[_p(prefix,'b_i')] = zero_bias(n_h)
-    params[_p(prefix,'b_f')] = zero_bias(n_h)
-    params[_p(prefix,'b_o')] = zero_bias(n_h)
-    params[_p(prefix,'b_c')] = zero_bias(n_h)
+    params[_p(prefix, 'Wa')] = uniform_weight(n_x,4*n_f)
+    params[_p(prefix, 'Wb')] = uniform_weight(n_y,4*n_f)
+    params[_p(prefix, 'Wc')] = uniform_weight(n_h,4*n_f)
+    
+    params[_p(prefix, 'Ua')] = uniform_weight(n_h,4*n_f)
+    params[_p(prefix, 'Ub')] = uniform_weight(n_y,4*n_f)
+    params[_p(prefix, 'Uc')] = uniform_weight(n_h,4*n_f)
+    
+    params[_p(prefix,'b')] = zero_bias(4*n_h)
+    
+    return params
+
+def fuse_gate_params(params, prefix='encoder_lstm'):
+    
+    """ Convert the per-gate weights of older models (Wa_i, Wa_f, ..., b_c)
+        into the stacked layout of param_init_encoder, in place.
+    """
+    for name in ['Wa', 'Wb', 'Wc', 'Ua', 'Ub', 'Uc', 'b']:
+        keys = [_p(prefix, '%s_%s' % (name, g)) for g in 'ifoc']
+        if keys[0] in params:
+            params[_p(prefix, name)] = np.concatenate([params.pop(kk) for kk in keys], axis=-1)
     
     return params
     
+def encoder_input(tparams, state_below, y, prefix='encoder_lstm'):
+    
+    """ state_below: size of n_steps * n_samples * n_x, or n_samples * n_x
+        Returns the input projections of the i/f/o/c gates modulated by the
+        tags y, of the same leading size * (4*n_h)
+    """
+    n_f = tparams[_p(prefix,'Ua')].shape[1] // 4
+    
+    tmp1 = tensor.dot(state_below, tparams[_p(prefix, 'Wa')]) 
+    tmp2 = tensor.dot(y, tparams[_p(prefix, 'Wb')])
+    if state_below.ndim == 3:
+        tmp2 = tmp2.dimshuffle('x',0,1)
+    tmp = tmp1*tmp2
+    
+    return tensor.concatenate([tensor.dot(_slice(tmp, k, n_f), _slice(tparams[_p(prefix, 'Wc')], k, n_f).T)
+                               for k in range(4)], axis=tmp.ndim-1) + tparams[_p(prefix, 'b')]
+
+def encoder_step(x_, h_, c_, Ua, Uc, yUb, m_=None):
+    
+    """ One step of the factored LSTM, x_: input projections of encoder_input,
+        yUb: the tag modulation of the recurrent factors, dot(y, Ub)
+        m_: mask of the samples, the masked ones keep h_ and c_
+    """
+    n_h = Ua.shape[0]
+    n_f = Ua.shape[1] // 4
+    
+    preact = tensor.dot(h_, Ua) * yUb
+    preact = tensor.concatenate([tensor.dot(_slice(preact, k, n_f), _slice(Uc, k, n_f).T)
+                                 for k in range(4)], axis=1) + x_
+    
+    i = tensor.nnet.sigmoid(_slice(preact, 0, n_h))
+    f = tensor.nnet.sigmoid(_slice(preact, 1, n_h))
+    o = tensor.nnet.sigmoid(_slice(preact, 2, n_h))
+    c = tensor.tanh(_slice(preact, 3, n_h))
+    
+    c = f * c_ + i * c
+    if m_ is not None:
+        c = m_[:, None] * c + (1. - m_)[:, None] * c_
+
+    h = o * tensor.tanh(c)
+    if m_ is not None:
+        h = m_[:, None] * h + (1. - m_)[:, None] * h_
+
+    return h, c
+
+def _slice(_x, n, dim):
+    if _x.ndim == 3:
+        return _x[:, :, n*dim:(n+1)*dim]
+    return _x[:, n*dim:(n+1)*dim]
+    
 def encoder_layer(tparams, state_below, mask, y, seq_output=True, prefix='encoder_lstm'):
     
     """ state_below: size of  n_steps * n_samples * n_x
@@ -59,60 +100,20 @@ def encoder_layer(tparams, state_below, mask, y, seq_output=True, prefix='encode
     n_steps = state_below.shape[0]
     n_samples = state_below.shape[1]
 
-    n_h = tparams[_p(prefix,'Ua_i')].shape[0]
-
-    def _slice(_x, n, dim):
-        if _x.ndim == 3:
-            return _x[:, :, n*dim:(n+1)*dim]
-        return _x[:, n*dim:(n+1)*dim]
-        
-    tmp1_i = tensor.dot(state_below, tparams[_p(prefix, 'Wa_i')]) 
-    tmp1_f = tensor.dot(state_below, tparams[_p(prefix, 'Wa_f')])
-    tmp1_o = tensor.dot(state_below, tparams[_p(prefix, 'Wa_o')])
-    tmp1_c = tensor.dot(state_below, tparams[_p(prefix, 'Wa_c')])
-    
-    tmp2_i = tensor.dot(y, tparams[_p(prefix, 'Wb_i')]).dimshuffle('x',0,1)
-    tmp2_f = tensor.dot(y, tparams[_p(prefix, 'Wb_f')]).dimshuffle('x',0,1)
-    tmp2_o = tensor.dot(y, tparams[_p(prefix, 'Wb_o')]).dimshuffle('x',0,1)
-    tmp2_c = tensor.dot(y, tparams[_p(prefix, 'Wb_c')]).dimshuffle('x',0,1)
-    
-    # n_steps * n_sample * n_h
-    state_below_i = tensor.dot(tmp1_i*tmp2_i,tparams[_p(prefix, 'Wc_i')].T) + tparams[_p(prefix, 'b_i')] 
-    state_below_f = tensor.dot(tmp1_f*tmp2_f,tparams[_p(prefix, 'Wc_f')].T) + tparams[_p(prefix, 'b_f')] 
-    state_below_o = tensor.dot(tmp1_o*tmp2_o,tparams[_p(prefix, 'Wc_o')].T) + tparams[_p(prefix, 'b_o')]  
-    state_below_c = tensor.dot(tmp1_c*tmp2_c,tparams[_p(prefix, 'Wc_c')].T) + tparams[_p(prefix, 'b_c')]                   
-
-    def _step(m_, x_i, x_f, x_o, x_c, h_, c_, Ua_i, Ua_f, Ua_o, Ua_c, Ub_i, Ub_f, Ub_o, Ub_c, Uc_i, Uc_f, Uc_o, Uc_c,y):
-        preact_i = tensor.dot(h_, Ua_i) * (tensor.dot(y, Ub_i))
-        preact_i = tensor.dot(preact_i,Uc_i.T) + x_i
-        
-        preact_f = tensor.dot(h_, Ua_f) * (tensor.dot(y, Ub_f))
-        preact_f = tensor.dot(preact_f,Uc_f.T) + x_f
-        
-        preact_o = tensor.dot(h_, Ua_o) * (tensor.dot(y, Ub_o))
-        preact_o = tensor.dot(preact_o,Uc_o.T) + x_o
-        
-        preact_c = tensor.dot(h_, Ua_c) * (tensor.dot(y, Ub_c))
-        preact_c = tensor.dot(preact_c,Uc_c.T) + x_c
-        
-        i = tensor.nnet.sigmoid(preact_i)
-        f = tensor.nnet.sigmoid(preact_f)
-        o = tensor.nnet.sigmoid(preact_o)
-        c = tensor.tanh(preact_c)
-        
-        c = f * c_ + i * c
-        c = m_[:, None] * c + (1. - m_)[:, None] * c_
-
-        h = o * tensor.tanh(c)
-        h = m_[:, None] * h + (1. - m_)[:, None] * h_
+    n_h = tparams[_p(prefix,'Ua')].shape[0]
+    
+    # n_steps * n_sample * (4*n_h)
+    state_below_ = encoder_input(tparams, state_below, y, prefix)
+    
+    # y is constant over the caption, so its modulation of the recurrent
+    # factors is computed once per minibatch, size of n_samples * (4*n_f)
+    yUb = tensor.dot(y, tparams[_p(prefix, 'Ub')])
 
-        return h, c
+    def _step(m_, x_, h_, c_, Ua, Uc, yUb):
+        return encoder_step(x_, h_, c_, Ua, Uc, yUb, m_)
 
-    seqs = [mask, state_below_i,state_below_f,state_below_o,state_below_c]
-    non_seqs = [tparams[_p(prefix, 'Ua_i')],tparams[_p(prefix, 'Ua_f')],tparams[_p(prefix, 'Ua_o')],tparams[_p(prefix, 'Ua_c')],
-                tparams[_p(prefix, 'Ub_i')],tparams[_p(prefix, 'Ub_f')],tparams[_p(prefix, 'Ub_o')],tparams[_p(prefix, 'Ub_c')],
-                tparams[_p(prefix, 'Uc_i')],tparams[_p(prefix, 'Uc_f')],tparams[_p(prefix, 'Uc_o')],tparams[_p(prefix, 'Uc_c')],
-                y]
+    seqs = [mask, state_below_]
+    non_seqs = [tparams[_p(prefix, 'Ua')], tparams[_p(prefix, 'Uc')], yUb]
 
     rval, updates = theano.scan(_step,
                                 sequences=seqs,
@@ -41,6 +41,53 @@ def get_minibatches_idx(n, minibatch_size, shuffle=False):
         minibatches.append(idx_list[minibatch_start:])
 
     return zip(range(len(minibatches)), minibatches)
+
+def get_bucketed_minibatches_idx(lengths, minibatch_size, shuffle=False, bucket_size=20, exact=True):
+
+    """ Minibatches of captions of similar length, so little of a batch is padding.
+        lengths: length of every caption
+        The captions are sorted by length (ties in random order when shuffle)
+        and cut into buckets of bucket_size minibatches. With shuffle, the
+        captions are shuffled within their bucket and the minibatches across
+        all buckets. exact: keep the last, smaller minibatch, so every caption
+        is seen once per epoch; otherwise it is dropped.
+    """
+    lengths = np.asarray(lengths)
+    n = len(lengths)
+    if shuffle:
+        idx_list = np.random.permutation(n).astype("int32")
+        idx_list = idx_list[np.argsort(lengths[idx_list], kind='mergesort')]
+    else:
+        idx_list = np.argsort(lengths, kind='mergesort').astype("int32")
+
+    bucket = max(bucket_size, 1) * minibatch_size
+    minibatches = []
+    for bucket_start in range(0, n, bucket):
+        bucket_idx = idx_list[bucket_start:bucket_start + bucket]
+        if shuffle:
+            bucket_idx = bucket_idx[np.random.permutation(len(bucket_idx))]
+        for minibatch_start in range(0, len(bucket_idx), minibatch_size):
+            minibatch = bucket_idx[minibatch_start:minibatch_start + minibatch_size]
+            if exact or len(minibatch) == minibatch_size:
+                minibatches.append(minibatch)
+
+    if shuffle:
+        minibatches = [minibatches[i] for i in np.random.permutation(len(minibatches))]
+
+    return zip(range(len(minibatches)), minibatches)
+
+def padding_ratio(lengths, iterator):
+
+    """ Share of the padded (maxlen, batch) matrices of the minibatches in
+        iterator that is padding
+    """
+    lengths = np.asarray(lengths)
+    n_tokens = n_padded = 0
+    for _, idx in iterator:
+        n_tokens += np.sum(lengths[idx])
+        n_padded += np.max(lengths[idx]) * len(idx)
+
+    return 1. - n_tokens / float(max(n_padded, 1))
     
 def _p(pp, name):
     return '%s_%s' % (pp, name)